@@ -1,13 +1,21 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory, Response
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory, send_file, Response
+import json
+import multiprocessing
 import os
 import secrets
-import zipfile
-import io
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from werkzeug.utils import secure_filename
 import db
+import jobs
 from datetime import datetime
 import uuid
-from utils import add_watermark
+from utils import (DEFAULT_WATERMARK_ANGLE, DEFAULT_WATERMARK_OPACITY, MINIATURE_SIZE,
+                   create_derivatives, create_miniature, miniature_filename, render_commission_image,
+                   render_watermark_variant, watermark_variant_filename)
+from archives import (ArchiveEntry, archive_key, archive_size, build_cached_archive,
+                      get_cached_archive, stream_zip)
+from image_cache import IMAGE_FORMATS, IMAGE_MIMETYPES, IMAGE_WIDTHS, get_resized_image, snap_width, srcset_widths
 app = Flask(__name__)
 app.secret_key = secrets.token_hex(16)
 
@@ -25,19 +33,115 @@ def inject_site_info():
         'contact_link': db.get_contact_link()
     }
 
+# Default watermark settings for the upload and edit forms
+@app.context_processor
+def inject_watermark_defaults():
+    return {
+        'default_watermark_opacity': DEFAULT_WATERMARK_OPACITY,
+        'default_watermark_angle': DEFAULT_WATERMARK_ANGLE
+    }
+
+# processing value of uploads whose job gave up, for the dashboard placeholders
+@app.context_processor
+def inject_processing_failed():
+    return {'processing_failed': db.PROCESSING_FAILED}
+
+# Return the request's database connection to the pool
+@app.teardown_appcontext
+def close_db_connection(exception):
+    db.close_db_connection(exception)
+
 # Ensure the required directories exist
 os.makedirs('static/uploads/references', exist_ok=True)
 os.makedirs('static/uploads/commissions', exist_ok=True)
+# Originals of watermarked references, kept out of the static folder
+REFERENCE_ORIGINALS_FOLDER = os.path.join('originals', 'references')
+os.makedirs(REFERENCE_ORIGINALS_FOLDER, exist_ok=True)
 
 
-# Initialize the database on first startup
-if not os.path.exists('gallery.db'):
-    db.init_db()
+# Create the database or apply pending schema migrations
+db.init_db()
+# Don't carry the startup connection into forked gunicorn workers
+db.close_all_connections()
 
 # Authentication check
 def is_authenticated():
     return session.get('authenticated', False)
 
+# Folder of the responsive copies of reference images
+REFERENCE_DERIVATIVES_FOLDER = os.path.join('static/uploads/references', 'derivatives')
+
+# Create the responsive copies of an image and record them in the database
+def save_image_derivatives(kind, owner_id, source_path, output_dir):
+    return record_image_derivatives(kind, owner_id, output_dir, create_derivatives(source_path, output_dir))
+
+# Record responsive copies made by create_derivatives in output_dir
+def record_image_derivatives(kind, owner_id, output_dir, derivatives):
+    for derivative in derivatives:
+        # Paths relative to static/, with forward slashes for URLs
+        path = os.path.relpath(os.path.join(output_dir, derivative['filename']), 'static')
+        derivative['path'] = path.replace(os.sep, '/')
+    if derivatives:
+        db.add_image_derivatives(kind, owner_id, derivatives)
+    return derivatives
+
+# Delete the responsive copies of an image, from disk and from the database
+def remove_image_derivatives(kind, owner_id):
+    for derivative in db.get_image_derivatives(kind, [owner_id]).get(owner_id, []):
+        path = os.path.join('static', derivative['path'])
+        if os.path.exists(path):
+            os.remove(path)
+    db.delete_image_derivatives(kind, owner_id)
+
+# Watermark settings from a form, or None if no watermark was requested
+def get_watermark_settings(form):
+    if not form.get('watermark'):
+        return None
+    opacity = form.get('watermark_opacity', DEFAULT_WATERMARK_OPACITY, type=int)
+    angle = form.get('watermark_angle', DEFAULT_WATERMARK_ANGLE, type=int)
+    return {
+        'watermark_text': form.get('watermark_text') or None,
+        'watermark_opacity': min(100, max(0, opacity)),
+        'watermark_angle': min(90, max(-90, angle)),
+    }
+
+# Current watermark settings of a reference or commission image, like get_watermark_settings
+def get_item_watermark_settings(item):
+    if not item['watermarked']:
+        return None
+    # Items watermarked before settings were stored used the defaults
+    return {
+        'watermark_text': item['watermark_text'],
+        'watermark_opacity': item['watermark_opacity'] if item['watermark_opacity'] is not None
+                             else DEFAULT_WATERMARK_OPACITY,
+        'watermark_angle': item['watermark_angle'] if item['watermark_angle'] is not None
+                           else DEFAULT_WATERMARK_ANGLE,
+    }
+
+# Folders of the images of each derivative kind
+IMAGE_FOLDERS = {
+    db.DERIVATIVE_KIND_REFERENCE: 'static/uploads/references',
+    db.DERIVATIVE_KIND_COMMISSION_IMAGE: 'static/uploads/commissions',
+}
+
+# Add each item's srcset strings, by format, as item['srcsets']
+def attach_srcsets(kind, items, id_key='id', filename_key='filename'):
+    derivatives = db.get_image_derivatives(
+        kind, [item[id_key] for item in items if item[id_key] is not None])
+    for item in items:
+        srcsets = {}
+        for derivative in derivatives.get(item[id_key], []):
+            url = url_for('static', filename=derivative['path'])
+            srcsets.setdefault(derivative['format'], []).append(f"{url} {derivative['width']}w")
+        if not srcsets and item[id_key] is not None:
+            # No copies made at upload: resize on request instead, up to the image's own width
+            widths = srcset_widths(os.path.join(IMAGE_FOLDERS[kind], item[filename_key]))
+            for fmt in IMAGE_FORMATS:
+                srcsets[fmt] = [f"{url_for('resized_image', kind=kind, item_id=item[id_key], w=requested, fmt=fmt)} {width}w"
+                                for width, requested in widths]
+        item['srcsets'] = {fmt: ', '.join(candidates) for fmt, candidates in srcsets.items()}
+    return items
+
 # Routes
 @app.route('/')
 def index():
@@ -91,16 +195,61 @@ def logout():
     flash('You have been logged out')
     return redirect(url_for('index'))
 
+# Category, subcategory and page cursor from the query string
+def get_reference_filter_args():
+    category = request.args.get('category') or None
+    subcategory = request.args.get('subcategory') or None
+    cursor = request.args.get('cursor') or None
+    return category, subcategory, cursor
+
 @app.route('/references')
 def references():
     site_title = db.get_site_title()
     # Show private references if user is logged in
     include_private = is_authenticated()
-    organized_refs = db.get_organized_references(include_private=include_private)
-    categories = db.get_reference_categories()
-    folders = db.get_reference_folders()
-    return render_template('references.html', site_title=site_title, references=organized_refs,
-                          categories=categories, folders=folders)
+    category, subcategory, cursor = get_reference_filter_args()
+
+    try:
+        page, next_cursor = db.get_references_page(include_private, category, subcategory, after=cursor)
+    except ValueError:
+        flash('Invalid page')
+        return redirect(url_for('references', category=category, subcategory=subcategory))
+
+    attach_srcsets(db.DERIVATIVE_KIND_REFERENCE, page)
+    facets = db.get_reference_facets(include_private=include_private)
+    return render_template('references.html', site_title=site_title,
+                          references=db.organize_references(page), next_cursor=next_cursor,
+                          categories=list(facets), folders=facets.get(category, []),
+                          selected_category=category, selected_subcategory=subcategory)
+
+@app.route('/api/references')
+def api_references():
+    include_private = is_authenticated()
+    category, subcategory, cursor = get_reference_filter_args()
+
+    try:
+        page, next_cursor = db.get_references_page(include_private, category, subcategory, after=cursor)
+    except ValueError:
+        return jsonify({'error': 'Invalid page cursor'}), 400
+
+    references = []
+    for ref in attach_srcsets(db.DERIVATIVE_KIND_REFERENCE, page):
+        filename_base = os.path.splitext(ref['filename'])[0]
+        item = {
+            'id': ref['id'],
+            'name': ref['name'] or (ref['filename'].split('_', 1)[1] if '_' in ref['filename'] else ref['filename']),
+            'category': ref['category'],
+            'subcategory': ref['subcategory'],
+            'description': ref['description'],
+            'miniature_url': url_for('static', filename=f'uploads/references/{filename_base}_miniature.webp'),
+            'original_url': url_for('static', filename=f'uploads/references/{ref["filename"]}'),
+            'srcsets': ref['srcsets']
+        }
+        if include_private:
+            item['edit_url'] = url_for('dashboard_edit_reference', ref_id=ref['id'])
+        references.append(item)
+
+    return jsonify({'references': references, 'next_cursor': next_cursor})
 
 @app.route('/custom_reference/<link_id>')
 def custom_reference(link_id):
@@ -111,7 +260,8 @@ def custom_reference(link_id):
         flash('Custom reference link not found')
         return redirect(url_for('index'))
 
-    references = db.get_references_for_custom_ref(custom_ref['id'])
+    references = attach_srcsets(db.DERIVATIVE_KIND_REFERENCE,
+                                db.get_references_for_custom_ref(custom_ref['id']))
     categories = db.get_reference_categories()
     folders = db.get_reference_folders()
 
@@ -122,7 +272,8 @@ def custom_reference(link_id):
 @app.route('/commissions')
 def commissions():
     site_title = db.get_site_title()
-    commissions = db.get_public_commissions()
+    commissions = attach_srcsets(db.DERIVATIVE_KIND_COMMISSION_IMAGE, db.get_public_commissions(),
+                                 id_key='thumbnail_id', filename_key='thumbnail')
     return render_template('commissions.html', site_title=site_title, commissions=commissions)
 
 @app.route('/commission/<int:commission_id>')
@@ -134,6 +285,7 @@ def commission_detail(commission_id):
         flash('Commission not found')
         return redirect(url_for('commissions'))
 
+    attach_srcsets(db.DERIVATIVE_KIND_COMMISSION_IMAGE, commission['images'])
     return render_template('commission_detail.html', site_title=site_title,
                           commission=commission, images=commission['images'])
 
@@ -144,11 +296,100 @@ def api_commission_detail(commission_id):
     if not commission:
         return jsonify({'error': 'Commission not found'}), 404
 
+    attach_srcsets(db.DERIVATIVE_KIND_COMMISSION_IMAGE, commission['images'])
+    # Originals are only for the dashboard
+    for image in commission['images']:
+        image.pop('original_filename', None)
+
     # Format the date for JSON response
     if commission['commission_date'] and hasattr(commission['commission_date'], 'strftime'):
         commission['commission_date'] = commission['commission_date'].strftime('%Y-%m-%d')
 
-    return jsonify(commission)
+    return jsonify(dict(commission))
+
+@app.route('/api/search')
+def api_search():
+    query = request.args.get('q', '')
+    page = request.args.get('page', 1, type=int)
+    include_private = is_authenticated()
+
+    results, has_more = db.search(query, include_private=include_private, page=page)
+
+    items = []
+    for result in results:
+        item = {'kind': result['kind'], 'id': result['item_id']}
+        if result['kind'] == 'reference':
+            filename_base = os.path.splitext(result['filename'])[0]
+            item.update({
+                'title': result['name'] or result['filename'],
+                'category': result['category'],
+                'subcategory': result['subcategory'],
+                'url': url_for('static', filename=f'uploads/references/{result["filename"]}'),
+                'thumbnail_url': url_for('static', filename=f'uploads/references/{filename_base}_miniature.webp')
+            })
+        elif result['kind'] == 'commission':
+            item.update({
+                'title': result['title'],
+                'url': url_for('commission_detail', commission_id=result['item_id'])
+            })
+        else:
+            item.update({
+                'title': result['artist_name'],
+                'url': url_for('dashboard_edit_artist', artist_id=result['item_id'])
+            })
+        items.append(item)
+
+    return jsonify({'results': items, 'page': page, 'has_more': has_more})
+
+# Seconds browsers may reuse a resized image before revalidating it
+IMAGE_MAX_AGE = 3600
+
+# Source file of an image and whether it is public, or None if the
+# visitor may not see it
+def get_image_source(kind, item_id):
+    if kind == db.DERIVATIVE_KIND_REFERENCE:
+        item = db.get_reference_by_id(item_id)
+    elif kind == db.DERIVATIVE_KIND_COMMISSION_IMAGE:
+        item = db.get_commission_image(item_id)
+    else:
+        return None
+
+    if not item or not (item['public'] or is_authenticated()):
+        return None
+    source_path = os.path.join(IMAGE_FOLDERS[kind], item['filename'])
+    if not os.path.exists(source_path):
+        return None
+    return source_path, bool(item['public'])
+
+# Image resized to an allowed width, rendered on first request and cached
+@app.route('/img/<kind>/<int:item_id>')
+def resized_image(kind, item_id):
+    fmt = request.args.get('fmt', 'webp')
+    if fmt not in IMAGE_FORMATS:
+        return jsonify({'error': 'Unsupported format'}), 400
+    width = snap_width(request.args.get('w', IMAGE_WIDTHS[-1], type=int))
+
+    source = get_image_source(kind, item_id)
+    if not source:
+        return jsonify({'error': 'Image not found'}), 404
+    source_path, public = source
+
+    try:
+        path = get_resized_image(source_path, width, fmt)
+    except Exception as e:
+        print(f"Error resizing image: {e}")
+        return jsonify({'error': 'Image could not be resized'}), 500
+
+    # The cached file's mtime tracks its last use, so validators come from
+    # its name (a hash of the source's version) and the source itself
+    response = send_file(path, mimetype=IMAGE_MIMETYPES[fmt], max_age=IMAGE_MAX_AGE,
+                         etag=os.path.splitext(os.path.basename(path))[0],
+                         last_modified=os.path.getmtime(source_path))
+    if not public:
+        # Only the logged in browser may keep private images
+        response.cache_control.public = False
+        response.cache_control.private = True
+    return response
 
 # Dashboard routes (all require authentication)
 @app.route('/dashboard')
@@ -159,41 +400,160 @@ def dashboard():
     site_title = db.get_site_title()
     counts = db.get_dashboard_counts()
 
+    recent_jobs = db.get_recent_jobs()
+    for job in recent_jobs:
+        job['target'] = get_job_target(job)
+
     return render_template('dashboard/index.html', site_title=site_title,
                           ref_count=counts['ref_count'],
                           comm_count=counts['comm_count'],
                           artist_count=counts['artist_count'],
-                          custom_ref_count=counts['custom_ref_count'])
+                          custom_ref_count=counts['custom_ref_count'],
+                          jobs=recent_jobs)
+
+# What a job works on, for the dashboard: a dict with its label, the URL of its
+# edit page and whether its processing failed, or None
+def get_job_target(job):
+    payload = json.loads(job['payload'])
+    if 'ref_id' in payload:
+        reference = db.get_reference_by_id(payload['ref_id'])
+        if reference:
+            return {'label': f"Reference: {reference['name']}",
+                    'url': url_for('dashboard_edit_reference', ref_id=reference['id']),
+                    'failed': reference['processing'] == db.PROCESSING_FAILED}
+    elif 'commission_id' in payload:
+        commission = db.get_commission_by_id(payload['commission_id'], public_only=False)
+        if commission:
+            image_ids = set(payload.get('image_ids', []))
+            return {'label': f"Commission: {commission['title']}",
+                    'url': url_for('dashboard_edit_commission', commission_id=commission['id']),
+                    'failed': any(image['id'] in image_ids and image['processing'] == db.PROCESSING_FAILED
+                                  for image in commission['images'])}
+    elif 'custom_ref_id' in payload:
+        custom_ref = db.get_custom_reference_by_id(payload['custom_ref_id'])
+        if custom_ref:
+            return {'label': f"Custom reference: {custom_ref['name']}",
+                    'url': url_for('dashboard_edit_custom_reference', custom_ref_id=custom_ref['id']),
+                    'failed': False}
+    return None
+
+@app.route('/dashboard/jobs/retry/<int:job_id>', methods=['POST'])
+def dashboard_retry_job(job_id):
+    if not is_authenticated():
+        return redirect(url_for('login'))
 
-@app.route('/dashboard/generate_miniatures', methods=['GET'])
+    if db.retry_job(job_id):
+        flash('Job queued again')
+    else:
+        flash('Only failed jobs can be retried')
+    return redirect(url_for('dashboard'))
+
+# Status of a background job, polled by the dashboard
+@app.route('/dashboard/jobs/<int:job_id>')
+def dashboard_job_status(job_id):
+    if not is_authenticated():
+        return jsonify({'error': 'Authentication required'}), 401
+
+    job = db.get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+
+    return jsonify({
+        'id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'attempts': job['attempts'],
+        'max_attempts': job['max_attempts'],
+        'error': job['error'],
+        'details': json.loads(job['details']) if job['details'] else None,
+    })
+
+# Seconds between progress updates of the miniature regeneration job
+MINIATURES_PROGRESS_INTERVAL = 1.0
+# Processes making miniatures; each holds a decoded image
+MINIATURE_PROCESSES = min(4, os.cpu_count() or 1)
+# Start method of the image process pools. Forking this process would copy
+# the threads of the web server or the job worker mid-flight, so processes
+# come from a forkserver (or are spawned), running functions from utils.
+POOL_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+# Longest side of reference miniatures, as last chosen on the dashboard
+def get_miniature_size():
+    return db.get_miniature_size() or MINIATURE_SIZE
+
+# Remake reference miniatures in parallel. Miniatures newer than their image
+# are kept unless payload['force'] is set, e.g. after changing their size.
+@jobs.job_handler('regenerate_miniatures')
+def regenerate_miniatures(payload, report_progress):
+    folder = 'static/uploads/references'
+    size = payload.get('size') or get_miniature_size()
+
+    sources = []
+    skipped = 0
+    for ref in db.get_all_references():
+        if ref['processing']:
+            # Its own job makes its miniature
+            continue
+        source = os.path.join(folder, ref['filename'])
+        try:
+            source_mtime = os.stat(source).st_mtime
+        except FileNotFoundError:
+            continue
+        if not payload.get('force'):
+            try:
+                if os.stat(os.path.join(folder, miniature_filename(source))).st_mtime >= source_mtime:
+                    skipped += 1
+                    continue
+            except FileNotFoundError:
+                pass
+        sources.append(source)
+
+    details = {'total': len(sources) + skipped, 'skipped': skipped, 'created': 0, 'failed': 0,
+               'per_second': 0}
+    report_progress(0, details)
+    if not sources:
+        report_progress(1, details)
+        return
+
+    started = last_report = time.monotonic()
+    with ProcessPoolExecutor(max_workers=MINIATURE_PROCESSES, mp_context=POOL_CONTEXT) as executor:
+        futures = [executor.submit(create_miniature, source, folder, size) for source in sources]
+        for finished, future in enumerate(as_completed(futures), 1):
+            details['created' if future.result() else 'failed'] += 1
+            now = time.monotonic()
+            if finished == len(futures) or now - last_report >= MINIATURES_PROGRESS_INTERVAL:
+                last_report = now
+                details['per_second'] = round(finished / max(now - started, 1e-6), 1)
+                report_progress((skipped + finished) / details['total'], details)
+
+@app.route('/dashboard/generate_miniatures', methods=['POST'])
 def dashboard_generate_miniatures():
     if not is_authenticated():
         return redirect(url_for('login'))
 
-    # Get all references
-    references = db.get_all_references()
-    count = 0
+    size = min(2048, max(50, request.form.get('size', get_miniature_size(), type=int)))
+    # Existing miniatures have the old size, however recent they are
+    force = bool(request.form.get('force')) or size != get_miniature_size()
+    # New uploads get miniatures of the same size
+    db.update_miniature_size(size)
+    jobs.enqueue('regenerate_miniatures', {
+        'force': force,
+        'size': size,
+    })
 
-    # Generate miniatures for each reference
-    for ref in references:
-        filename = ref['filename']
-        file_path = os.path.join('static/uploads/references', filename)
+    flash('Miniatures are being generated, see the progress below')
+    return redirect(url_for('dashboard'))
 
-        # Check if file exists
-        if os.path.exists(file_path):
-            # Check if miniature already exists
-            filename_parts = filename.split('.')
-            filename_base = '.'.join(filename_parts[:-1]) if len(filename_parts) > 1 else filename
-            miniature_path = os.path.join('static/uploads/references', f"{filename_base}_miniature.webp")
-
-            if not os.path.exists(miniature_path):
-                # Create miniature
-                from utils import create_miniature
-                if create_miniature(file_path, 'static/uploads/references'):
-                    count += 1
-
-    flash(f'Generated {count} miniatures for existing references')
-    return redirect(url_for('dashboard_references'))
+@app.route('/dashboard/rewatermark', methods=['POST'])
+def dashboard_rewatermark():
+    if not is_authenticated():
+        return redirect(url_for('login'))
+
+    jobs.enqueue('rewatermark_all', {'settings': get_watermark_settings(request.form)})
+    flash('Watermarks are being re-applied, see the progress below')
+    return redirect(url_for('dashboard'))
 
 @app.route('/dashboard/settings', methods=['GET', 'POST'])
 def dashboard_settings():
@@ -218,12 +578,13 @@ def dashboard_references():
         return redirect(url_for('login'))
 
     site_title = db.get_site_title()
-    references = db.get_all_references()
+    references = attach_srcsets(db.DERIVATIVE_KIND_REFERENCE, db.get_all_references())
     categories = db.get_reference_categories()
     folders = db.get_reference_folders()
 
     return render_template('dashboard/references.html', site_title=site_title,
-                          references=references, categories=categories, folders=folders)
+                          references=references, categories=categories, folders=folders,
+                          miniature_size=get_miniature_size())
 
 @app.route('/dashboard/rename_category', methods=['POST'])
 def dashboard_rename_category():
@@ -280,7 +641,6 @@ def dashboard_add_reference():
         subcategory = request.form.get('subcategory')
         description = request.form.get('description')
         public = 1 if request.form.get('public') else 0
-        watermark = 1 if request.form.get('watermark') else 0
         name = request.form.get('name')
 
         if 'file' not in request.files:
@@ -296,36 +656,120 @@ def dashboard_add_reference():
             filename = secure_filename(file.filename)
             # Add timestamp to filename to avoid duplicates
             filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{filename}"
-            file_path = os.path.join('static/uploads/references', filename)
-
-            # Save the file
-            file.save(file_path)
 
             # If name is not provided, use the original filename without timestamp
             if not name:
                 name = filename.split('_', 1)[1] if '_' in filename else filename
 
-            # Add watermark if requested
-            if watermark:
-                watermarked_path = os.path.join('static/uploads/references', f"watermarked_{filename}")
-                # Get custom watermark text if provided
-                watermark_text = request.form.get('watermark_text')
-                if add_watermark(file_path, watermarked_path, watermark_text):
-                    # Replace original with watermarked version
-                    os.replace(watermarked_path, file_path)
-
-            # Create miniature version for faster loading in cards
-            from utils import create_miniature
-            create_miniature(file_path, 'static/uploads/references')
-
-            # Save to database
-            db.add_reference(filename, name, category, subcategory, description, public, watermark)
-            flash('Reference added successfully')
+            # Save the file, keeping the original aside if a watermark is requested.
+            # The watermarked copy's name is known now, the worker renders it.
+            settings = get_watermark_settings(request.form)
+            original_filename = None
+            if settings:
+                original_filename = filename
+                file.save(os.path.join(REFERENCE_ORIGINALS_FOLDER, original_filename))
+                filename = watermark_variant_filename(original_filename, settings['watermark_text'],
+                                                      settings['watermark_opacity'], settings['watermark_angle'])
+            else:
+                file.save(os.path.join('static/uploads/references', filename))
+
+            # Save to database, shown as processing until the worker is done
+            ref_id = db.add_reference(filename, name, category, subcategory, description, public,
+                                      1 if settings else 0, original_filename, **(settings or {}),
+                                      processing=1)
+            jobs.enqueue('process_reference', {'ref_id': ref_id})
+            flash('Reference added successfully, its image is being processed')
             return redirect(url_for('dashboard_references'))
 
     return render_template('dashboard/add_reference.html', site_title=site_title,
                           categories=categories, folders=folders)
 
+# Mark a reference whose processing job gave up, so the dashboard shows it
+def fail_reference_processing(payload):
+    db.set_reference_processing(payload['ref_id'], db.PROCESSING_FAILED)
+
+# Render a new reference's watermarked copy, miniature and responsive copies
+@jobs.job_handler('process_reference', on_failure=fail_reference_processing)
+def process_reference(payload, report_progress):
+    reference = db.get_reference_by_id(payload['ref_id'])
+    if not reference:
+        # Deleted before it was processed
+        return
+
+    folder = 'static/uploads/references'
+    settings = get_item_watermark_settings(reference)
+    if settings and not render_watermark_variant(
+            os.path.join(REFERENCE_ORIGINALS_FOLDER, reference['original_filename']), folder, settings):
+        raise RuntimeError(f"Could not watermark reference {reference['id']}")
+    report_progress(1 / 3)
+
+    # Create miniature version for faster loading in cards
+    file_path = os.path.join(folder, reference['filename'])
+    if not create_miniature(file_path, folder, get_miniature_size()):
+        raise RuntimeError(f"Could not create the miniature of reference {reference['id']}")
+    report_progress(2 / 3)
+
+    # Create responsive copies for srcset
+    save_image_derivatives(db.DERIVATIVE_KIND_REFERENCE, reference['id'], file_path,
+                           REFERENCE_DERIVATIVES_FOLDER)
+    db.set_reference_processing(reference['id'], 0)
+
+# Show a reference with new watermark settings, or its original if settings is None.
+# Only the watermarked copy, miniature and responsive copies are remade.
+def set_reference_watermark(reference, settings):
+    folder = 'static/uploads/references'
+    filename = reference['filename']
+    original_filename = reference['original_filename']
+
+    if reference['watermarked'] and not original_filename:
+        # Watermarked before originals were kept: there is nothing to render from
+        print(f"Error changing watermark: the original of reference {reference['id']} was not kept")
+        return False
+
+    if settings:
+        original_path = os.path.join(REFERENCE_ORIGINALS_FOLDER if original_filename else folder,
+                                     original_filename or filename)
+        new_filename = render_watermark_variant(original_path, folder, settings)
+        if not new_filename:
+            return False
+        if not original_filename:
+            # The shown file was the original: keep it aside
+            os.replace(original_path, os.path.join(REFERENCE_ORIGINALS_FOLDER, filename))
+            original_filename = filename
+    elif original_filename:
+        # Show the original again
+        os.replace(os.path.join(REFERENCE_ORIGINALS_FOLDER, original_filename),
+                   os.path.join(folder, original_filename))
+        new_filename, original_filename = original_filename, None
+    else:
+        return True
+
+    db.update_reference_watermark(reference['id'], new_filename, original_filename, 1 if settings else 0,
+                                  **(settings or {'watermark_text': None, 'watermark_opacity': None,
+                                                  'watermark_angle': None}))
+
+    if new_filename != filename:
+        # Drop the previous watermarked copy and everything made from it
+        old_path = os.path.join(folder, filename)
+        if os.path.exists(old_path):
+            os.remove(old_path)
+        old_miniature = os.path.join(folder, f"{os.path.splitext(filename)[0]}_miniature.webp")
+        if os.path.exists(old_miniature):
+            os.remove(old_miniature)
+        remove_image_derivatives(db.DERIVATIVE_KIND_REFERENCE, reference['id'])
+
+        new_path = os.path.join(folder, new_filename)
+        create_miniature(new_path, folder, get_miniature_size())
+        save_image_derivatives(db.DERIVATIVE_KIND_REFERENCE, reference['id'], new_path,
+                               REFERENCE_DERIVATIVES_FOLDER)
+    return True
+
+@jobs.job_handler('set_reference_watermark')
+def set_reference_watermark_job(payload, report_progress):
+    reference = db.get_reference_by_id(payload['ref_id'])
+    if reference and not set_reference_watermark(reference, payload['settings']):
+        raise RuntimeError(f"Could not change the watermark of reference {reference['id']}")
+
 @app.route('/dashboard/references/edit/<int:ref_id>', methods=['GET', 'POST'])
 def dashboard_edit_reference(ref_id):
     if not is_authenticated():
@@ -354,9 +798,19 @@ def dashboard_edit_reference(ref_id):
 
         # Update reference
         db.update_reference(ref_id, name, category, subcategory, description, public)
+
+        # Have the worker re-render the watermarked copy if its settings changed
+        settings = get_watermark_settings(request.form)
+        if settings != get_item_watermark_settings(reference):
+            if reference['watermarked'] and not reference['original_filename']:
+                # Watermarked before originals were kept: there is nothing to render from
+                flash('Could not change the watermark of this reference')
+            else:
+                jobs.enqueue('set_reference_watermark', {'ref_id': ref_id, 'settings': settings})
         flash('Reference updated successfully')
         return redirect(url_for('dashboard_references'))
 
+    attach_srcsets(db.DERIVATIVE_KIND_REFERENCE, [reference])
     return render_template('dashboard/edit_reference.html', site_title=site_title,
                           reference=reference, categories=categories, folders=folders)
 
@@ -365,7 +819,13 @@ def dashboard_delete_reference(ref_id):
     if not is_authenticated():
         return redirect(url_for('login'))
 
-    # Delete reference and get filename
+    # Delete the reference's responsive copies and kept original, then the reference, and get its filename
+    reference = db.get_reference_by_id(ref_id)
+    if reference and reference['original_filename']:
+        original_path = os.path.join(REFERENCE_ORIGINALS_FOLDER, reference['original_filename'])
+        if os.path.exists(original_path):
+            os.remove(original_path)
+    remove_image_derivatives(db.DERIVATIVE_KIND_REFERENCE, ref_id)
     filename = db.delete_reference(ref_id)
 
     if filename:
@@ -399,6 +859,13 @@ def dashboard_custom_references():
     return render_template('dashboard/custom_references.html', site_title=site_title,
                           custom_refs=custom_refs)
 
+# Reference ids selected in a custom reference form, or None if one isn't an id
+def get_selected_reference_ids(form):
+    try:
+        return {int(ref_id) for ref_id in form.getlist('references')}
+    except ValueError:
+        return None
+
 @app.route('/dashboard/custom_references/add', methods=['GET', 'POST'])
 def dashboard_add_custom_reference():
     if not is_authenticated():
@@ -409,8 +876,11 @@ def dashboard_add_custom_reference():
 
     if request.method == 'POST':
         name = request.form.get('name')
-        selected_refs = request.form.getlist('references')
+        selected_refs = get_selected_reference_ids(request.form)
 
+        if selected_refs is None:
+            flash('Invalid reference selection')
+            return redirect(request.url)
         if not name or not selected_refs:
             flash('Name and at least one reference are required')
             return redirect(request.url)
@@ -419,10 +889,12 @@ def dashboard_add_custom_reference():
         link_id = str(uuid.uuid4())[:8]
 
         # Create custom reference
-        db.create_custom_reference(name, link_id, selected_refs)
+        custom_ref_id = db.create_custom_reference(name, link_id, selected_refs)
+        prebuild_custom_reference_archive(custom_ref_id)
         flash('Custom reference created successfully')
         return redirect(url_for('dashboard_custom_references'))
 
+    attach_srcsets(db.DERIVATIVE_KIND_REFERENCE, references)
     return render_template('dashboard/add_custom_reference.html', site_title=site_title,
                           references=references)
 
@@ -443,17 +915,22 @@ def dashboard_edit_custom_reference(custom_ref_id):
 
     if request.method == 'POST':
         name = request.form.get('name')
-        new_selected_refs = request.form.getlist('references')
+        new_selected_refs = get_selected_reference_ids(request.form)
 
+        if new_selected_refs is None:
+            flash('Invalid reference selection')
+            return redirect(request.url)
         if not name or not new_selected_refs:
             flash('Name and at least one reference are required')
             return redirect(request.url)
 
         # Update custom reference
         db.update_custom_reference(custom_ref_id, name, new_selected_refs)
+        prebuild_custom_reference_archive(custom_ref_id)
         flash('Custom reference updated successfully')
         return redirect(url_for('dashboard_custom_references'))
 
+    attach_srcsets(db.DERIVATIVE_KIND_REFERENCE, all_references)
     return render_template('dashboard/edit_custom_reference.html', site_title=site_title,
                           custom_ref=custom_ref, all_references=all_references, 
                           selected_refs=selected_refs)
@@ -548,10 +1025,199 @@ def dashboard_commissions():
         return redirect(url_for('login'))
 
     site_title = db.get_site_title()
-    commissions = db.get_all_commissions()
+    commissions = attach_srcsets(db.DERIVATIVE_KIND_COMMISSION_IMAGE, db.get_all_commissions(),
+                                 id_key='thumbnail_id', filename_key='thumbnail')
 
     return render_template('dashboard/commissions.html', site_title=site_title, commissions=commissions)
 
+# Save an uploaded commission image. Returns the values of its database row,
+# pointing at the watermarked copy the worker renders if settings are given.
+def save_commission_image(commission_id, image, original_filename, settings):
+    commission_folder = os.path.join('static/uploads/commissions', str(commission_id))
+    original_path = os.path.join(commission_folder, 'original', original_filename)
+
+    # Save the original file. Unlike reference originals, it stays under static:
+    # commission originals are delivered to the client in the archive.
+    image.save(original_path)
+
+    # Paths relative to static/uploads/commissions, with forward slashes for URLs
+    original_db_path = f"{commission_id}/original/{original_filename}"
+    row = {'filename': original_db_path, 'original_filename': original_db_path, 'watermarked': 0,
+           'watermark_text': None, 'watermark_opacity': None, 'watermark_angle': None, 'processing': 1}
+
+    # Show a watermarked copy if requested; the original stays in original/
+    if settings:
+        watermarked_filename = watermark_variant_filename(
+            original_filename, settings['watermark_text'], settings['watermark_opacity'],
+            settings['watermark_angle'], ext='.jpg')
+        row.update(settings, watermarked=1,
+                   filename=f"{commission_id}/watermarked/{watermarked_filename}")
+    return row
+
+# Processes rendering the watermarked and responsive copies of commission images
+COMMISSION_RENDER_PROCESSES = min(4, os.cpu_count() or 1)
+
+# Save uploaded commission images, insert their rows in one
+# transaction and queue the job rendering their copies. images are
+# (display_order, file) pairs. Returns the new image ids.
+def ingest_commission_images(commission_id, images, settings):
+    if not images:
+        return []
+
+    # Create commission folder structure
+    commission_folder = os.path.join('static/uploads/commissions', str(commission_id))
+    os.makedirs(os.path.join(commission_folder, 'original'), exist_ok=True)
+    os.makedirs(os.path.join(commission_folder, 'watermarked'), exist_ok=True)
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+
+    rows = []
+    for display_order, image in images:
+        # Add timestamp and index to avoid duplicates
+        original_filename = f"{timestamp}_{display_order}_{secure_filename(image.filename)}"
+        row = save_commission_image(commission_id, image, original_filename, settings)
+        row['display_order'] = display_order
+        rows.append(row)
+
+    image_ids = db.add_commission_images(commission_id, rows)
+    jobs.enqueue('process_commission_images', {'commission_id': commission_id, 'image_ids': image_ids})
+    return image_ids
+
+# Mark the images a commission processing job gave up on
+def fail_commission_images_processing(payload):
+    images = [db.get_commission_image(image_id) for image_id in payload['image_ids']]
+    db.set_commission_images_processing(
+        [image['id'] for image in images if image and image['processing']], db.PROCESSING_FAILED)
+
+# Render the watermarked and responsive copies of new commission images
+@jobs.job_handler('process_commission_images', on_failure=fail_commission_images_processing)
+def process_commission_images(payload, report_progress):
+    commission_id = payload['commission_id']
+    uploads = 'static/uploads/commissions'
+    watermarked_folder = os.path.join(uploads, str(commission_id), 'watermarked')
+    derivatives_folder = os.path.join(uploads, str(commission_id), 'derivatives')
+
+    image_ids = payload['image_ids']
+    # Skip images deleted since, or processed by an earlier attempt
+    images = [image for image in map(db.get_commission_image, image_ids) if image and image['processing']]
+    done = len(image_ids) - len(images)
+    failed = []
+
+    with ProcessPoolExecutor(max_workers=COMMISSION_RENDER_PROCESSES, mp_context=POOL_CONTEXT) as executor:
+        futures = {executor.submit(render_commission_image,
+                                   os.path.join(uploads, image['original_filename']),
+                                   os.path.join(uploads, image['filename']),
+                                   watermarked_folder, derivatives_folder,
+                                   get_item_watermark_settings(image)): image['id'] for image in images}
+        for future in as_completed(futures):
+            image_id = futures[future]
+            derivatives = future.result()
+            if derivatives is None:
+                failed.append(image_id)
+            else:
+                record_image_derivatives(db.DERIVATIVE_KIND_COMMISSION_IMAGE, image_id, derivatives_folder,
+                                         derivatives)
+                db.set_commission_images_processing([image_id], 0)
+            done += 1
+            report_progress(done / len(image_ids))
+
+    if failed:
+        # The next attempt only renders these
+        raise RuntimeError(f"Could not watermark commission images {', '.join(map(str, failed))}")
+    build_commission_archive(commission_id)
+
+# Show a commission's images with new watermark settings, or their originals if
+# settings is None. Only watermarked and responsive copies are remade.
+def set_commission_watermarks(commission_id, images, settings):
+    uploads = 'static/uploads/commissions'
+    watermarked_folder = os.path.join(uploads, str(commission_id), 'watermarked')
+    derivatives_folder = os.path.join(uploads, str(commission_id), 'derivatives')
+    os.makedirs(watermarked_folder, exist_ok=True)
+
+    changed = []
+    for image in images:
+        if not image['original_filename']:
+            # Uploaded before originals were linked to their watermarked copy
+            continue
+
+        update = {'id': image['id'], 'filename': image['original_filename'], 'watermarked': 0,
+                  'watermark_text': None, 'watermark_opacity': None, 'watermark_angle': None}
+        if settings:
+            watermarked_filename = render_watermark_variant(
+                os.path.join(uploads, image['original_filename']), watermarked_folder, settings, ext='.jpg')
+            if not watermarked_filename:
+                continue
+            update.update(settings, watermarked=1,
+                          filename=f"{commission_id}/watermarked/{watermarked_filename}")
+
+        if update['filename'] != image['filename']:
+            changed.append((image, update))
+
+    if not changed or not db.update_commission_image_watermarks([update for _, update in changed]):
+        return 0
+
+    for image, update in changed:
+        # Drop the previous watermarked copy and its responsive copies
+        if image['filename'] != image['original_filename']:
+            old_path = os.path.join(uploads, image['filename'])
+            if os.path.exists(old_path):
+                os.remove(old_path)
+        remove_image_derivatives(db.DERIVATIVE_KIND_COMMISSION_IMAGE, image['id'])
+        save_image_derivatives(db.DERIVATIVE_KIND_COMMISSION_IMAGE, image['id'],
+                               os.path.join(uploads, update['filename']), derivatives_folder)
+    return len(changed)
+
+@jobs.job_handler('set_commission_watermarks')
+def set_commission_watermarks_job(payload, report_progress):
+    images = [image for image in map(db.get_commission_image, payload['image_ids']) if image]
+    set_commission_watermarks(payload['commission_id'], images, payload['settings'])
+    build_commission_archive(payload['commission_id'])
+
+# Seconds between progress updates of the re-watermarking job
+REWATERMARK_PROGRESS_INTERVAL = 1.0
+
+# Re-render every watermarked reference and commission image with new settings,
+# from their kept originals. Items already watermarked with them are skipped;
+# items whose original was not kept are counted as failed without failing the job.
+@jobs.job_handler('rewatermark_all')
+def rewatermark_all(payload, report_progress):
+    settings = payload['settings']
+    references = [ref for ref in db.get_all_references() if ref['watermarked'] and not ref['processing']]
+    commissions = {}
+    for image in db.get_watermarked_commission_images():
+        commissions.setdefault(image['commission_id'], []).append(image)
+
+    details = {'total': len(references) + sum(map(len, commissions.values())), 'skipped': 0, 'created': 0,
+               'failed': 0, 'per_second': 0}
+    report_progress(0, details)
+    started = last_report = time.monotonic()
+
+    def progress():
+        nonlocal last_report
+        now = time.monotonic()
+        done = details['created'] + details['skipped'] + details['failed']
+        if done == details['total'] or now - last_report >= REWATERMARK_PROGRESS_INTERVAL:
+            last_report = now
+            details['per_second'] = round(done / max(now - started, 1e-6), 1)
+            report_progress(done / details['total'], details)
+
+    for reference in references:
+        if get_item_watermark_settings(reference) == settings:
+            details['skipped'] += 1
+        else:
+            details['created' if set_reference_watermark(reference, settings) else 'failed'] += 1
+        progress()
+
+    for commission_id, images in commissions.items():
+        outdated = [image for image in images if get_item_watermark_settings(image) != settings]
+        details['skipped'] += len(images) - len(outdated)
+        if outdated:
+            changed = set_commission_watermarks(commission_id, outdated, settings)
+            details['created'] += changed
+            details['failed'] += len(outdated) - changed
+            if changed:
+                build_commission_archive(commission_id)
+        progress()
+
 @app.route('/dashboard/commissions/add', methods=['GET', 'POST'])
 def dashboard_add_commission():
     if not is_authenticated():
@@ -559,7 +1225,7 @@ def dashboard_add_commission():
 
     site_title = db.get_site_title()
     artists = db.get_all_artists()
-    custom_refs = db.get_custom_references()
+    custom_refs = db.get_custom_reference_choices()
 
     if request.method == 'POST':
         title = request.form.get('title')
@@ -582,8 +1248,7 @@ def dashboard_add_commission():
         # Handle image uploads
         if 'images' in request.files:
             images = request.files.getlist('images')
-            watermark = 1 if request.form.get('watermark') else 0
-            watermark_text = request.form.get('watermark_text')
+            watermark_settings = get_watermark_settings(request.form)
 
             # Get image order from form if available
             image_order = request.form.get('image-order', '')
@@ -600,58 +1265,18 @@ def dashboard_add_commission():
                 # If no order specified, use default order
                 ordered_indices = list(range(len(images)))
 
-            # Create commission folder structure
-            commission_folder = os.path.join('static/uploads/commissions', str(commission_id))
-            original_folder = os.path.join(commission_folder, 'original')
-            watermarked_folder = os.path.join(commission_folder, 'watermarked')
-
-            # Create directories if they don't exist
-            os.makedirs(original_folder, exist_ok=True)
-            os.makedirs(watermarked_folder, exist_ok=True)
+            # Uploaded images by their index in the form
+            images_by_index = {i: image for i, image in enumerate(images) if image and image.filename}
 
-            # Create a list to store image objects with their original indices
-            image_list = []
-            for i, image in enumerate(images):
-                if image and image.filename:
-                    image_list.append((i, image))
-
-            # Process images in the order specified by ordered_indices
+            # Take images in the order specified by ordered_indices, each at most once
+            ordered_images = []
             for display_order, original_idx in enumerate(ordered_indices):
-                # Find the image with the original index
-                for idx, (i, image) in enumerate(image_list):
-                    if i == original_idx:
-                        # Original filename for storage
-                        original_filename = secure_filename(image.filename)
-                        # Add timestamp and index to avoid duplicates
-                        original_filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{display_order}_{original_filename}"
-                        original_path = os.path.join(original_folder, original_filename)
-
-                        # Save the original file
-                        image.save(original_path)
-
-                        # Database filename (path relative to static/uploads)
-                        db_filename = original_filename
-                        # Use forward slashes for URL paths
-                        db_path = f"{str(commission_id)}/original/{original_filename}"
-
-                        # Add watermark if requested
-                        if watermark:
-                            # Generate UUID for watermarked image
-                            watermarked_filename = f"{uuid.uuid4()}.jpg"
-                            watermarked_path = os.path.join(watermarked_folder, watermarked_filename)
-
-                            if add_watermark(original_path, watermarked_path, watermark_text):
-                                # Use watermarked image for display
-                                db_filename = watermarked_filename
-                                # Use forward slashes for URL paths
-                                db_path = f"{str(commission_id)}/watermarked/{watermarked_filename}"
-
-                        # Save to database with the appropriate path
-                        db.add_commission_image(commission_id, db_path, display_order)
-
-                        # Remove the processed image from the list
-                        image_list.pop(idx)
-                        break
+                image = images_by_index.pop(original_idx, None)
+                if image:
+                    ordered_images.append((display_order, image))
+
+            # The job rendering their copies also builds the archive
+            ingest_commission_images(commission_id, ordered_images, watermark_settings)
 
         flash('Commission added successfully')
         return redirect(url_for('dashboard_commissions'))
@@ -672,7 +1297,7 @@ def dashboard_edit_commission(commission_id):
         return redirect(url_for('dashboard_commissions'))
 
     artists = db.get_all_artists()
-    custom_refs = db.get_custom_references()
+    custom_refs = db.get_custom_reference_choices()
     images = commission['images']
 
     if request.method == 'POST':
@@ -700,63 +1325,41 @@ def dashboard_edit_commission(commission_id):
                 # Convert comma-separated string to list of image IDs
                 ordered_image_ids = [int(img_id) for img_id in image_order.split(',')]
 
-                # Create a list of tuples (image_id, display_order)
-                image_orders = [(img_id, idx) for idx, img_id in enumerate(ordered_image_ids)]
-
-                # Update the display_order of images in the database
-                db.update_commission_image_order(image_orders)
+                # Update the display_order of this commission's images in the database
+                db.update_commission_image_order(commission_id, ordered_image_ids)
             except ValueError as e:
                 print(f"Error processing image order: {e}")
 
+        # Have the worker re-render the existing images' watermarked copies if asked to
+        queued = False
+        if request.form.get('apply_watermark_to_existing') and commission['images']:
+            jobs.enqueue('set_commission_watermarks', {
+                'commission_id': commission_id,
+                'image_ids': [image['id'] for image in commission['images']],
+                'settings': get_watermark_settings(request.form),
+            })
+            queued = True
+
         # Handle image uploads
         if 'images' in request.files:
             images = request.files.getlist('images')
-            watermark = 1 if request.form.get('watermark') else 0
-            watermark_text = request.form.get('watermark_text')
-
-            # Create commission folder structure
-            commission_folder = os.path.join('static/uploads/commissions', str(commission_id))
-            original_folder = os.path.join(commission_folder, 'original')
-            watermarked_folder = os.path.join(commission_folder, 'watermarked')
-
-            # Create directories if they don't exist
-            os.makedirs(original_folder, exist_ok=True)
-            os.makedirs(watermarked_folder, exist_ok=True)
-
-            for i, image in enumerate(images):
-                if image and image.filename:
-                    # Original filename for storage
-                    original_filename = secure_filename(image.filename)
-                    # Add timestamp and index to avoid duplicates
-                    original_filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{i}_{original_filename}"
-                    original_path = os.path.join(original_folder, original_filename)
-
-                    # Save the original file
-                    image.save(original_path)
-
-                    # Database filename (path relative to static/uploads)
-                    db_filename = original_filename
-                    # Use forward slashes for URL paths
-                    db_path = f"{str(commission_id)}/original/{original_filename}"
-
-                    # Add watermark if requested
-                    if watermark:
-                        # Generate UUID for watermarked image
-                        watermarked_filename = f"{uuid.uuid4()}.jpg"
-                        watermarked_path = os.path.join(watermarked_folder, watermarked_filename)
-
-                        if add_watermark(original_path, watermarked_path, watermark_text):
-                            # Use watermarked image for display
-                            db_filename = watermarked_filename
-                            # Use forward slashes for URL paths
-                            db_path = f"{str(commission_id)}/watermarked/{watermarked_filename}"
-
-                    # Save to database with the appropriate path
-                    db.add_commission_image(commission_id, db_path, i + len(commission['images']))
+            watermark_settings = get_watermark_settings(request.form)
+
+            # New images go after the existing ones
+            new_images = [(i + len(commission['images']), image)
+                          for i, image in enumerate(images) if image and image.filename]
+            if ingest_commission_images(commission_id, new_images, watermark_settings):
+                queued = True
+
+        # Queued jobs build the archive when they are done. Otherwise this
+        # reuses the cached archive if no file changed.
+        if not queued:
+            prebuild_commission_archive(commission_id)
 
         flash('Commission updated successfully')
         return redirect(url_for('dashboard_commissions'))
 
+    attach_srcsets(db.DERIVATIVE_KIND_COMMISSION_IMAGE, images)
     return render_template('dashboard/edit_commission.html', site_title=site_title,
                           commission=commission, artists=artists, 
                           custom_refs=custom_refs, images=images)
@@ -772,23 +1375,15 @@ def dashboard_delete_commission(commission_id):
     # Delete the entire commission folder
     commission_folder = os.path.join('static/uploads/commissions', str(commission_id))
     if os.path.exists(commission_folder) and os.path.isdir(commission_folder):
-        # Delete all files in the original subfolder
-        original_folder = os.path.join(commission_folder, 'original')
-        if os.path.exists(original_folder):
-            for file in os.listdir(original_folder):
-                file_path = os.path.join(original_folder, file)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-            os.rmdir(original_folder)
-
-        # Delete all files in the watermarked subfolder
-        watermarked_folder = os.path.join(commission_folder, 'watermarked')
-        if os.path.exists(watermarked_folder):
-            for file in os.listdir(watermarked_folder):
-                file_path = os.path.join(watermarked_folder, file)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-            os.rmdir(watermarked_folder)
+        # Delete all files in the original, watermarked and derivatives subfolders
+        for subfolder in ('original', 'watermarked', 'derivatives'):
+            subfolder_path = os.path.join(commission_folder, subfolder)
+            if os.path.exists(subfolder_path):
+                for file in os.listdir(subfolder_path):
+                    file_path = os.path.join(subfolder_path, file)
+                    if os.path.isfile(file_path):
+                        os.remove(file_path)
+                os.rmdir(subfolder_path)
 
         # Remove the commission folder itself
         os.rmdir(commission_folder)
@@ -801,7 +1396,8 @@ def dashboard_delete_commission_image(image_id):
     if not is_authenticated():
         return redirect(url_for('login'))
 
-    # Delete image and get details
+    # Delete the image's responsive copies, then the image, and get its details
+    remove_image_derivatives(db.DERIVATIVE_KIND_COMMISSION_IMAGE, image_id)
     result = db.delete_commission_image(image_id)
 
     if result:
@@ -815,17 +1411,12 @@ def dashboard_delete_commission_image(image_id):
         if os.path.exists(file_path):
             os.remove(file_path)
 
-        # Check if this is a watermarked image and delete the original too if needed
-        if 'watermarked' in filename:
-            # Get the original filename by replacing 'watermarked' with 'original'
-            # This is a simplistic approach - in a real system you might want to store
-            # the relationship between original and watermarked files in the database
-            parts = filename.split('/')
-            if len(parts) >= 3 and parts[1] == 'watermarked':
-                # The original should be in the same commission folder but in 'original' subfolder
-                # We don't know the original filename, so we can't delete it directly
-                # In a real system, you would store this relationship in the database
-                pass
+        # Delete the original too if this was its watermarked copy
+        original_filename = result['original_filename']
+        if original_filename and original_filename != filename:
+            original_path = os.path.join('static/uploads/commissions', original_filename)
+            if os.path.exists(original_path):
+                os.remove(original_path)
 
         flash('Image deleted successfully')
     else:
@@ -847,41 +1438,117 @@ def download_commission_folder(commission_id):
         flash('Commission not found')
         return redirect(url_for('commissions'))
 
-    # Create in-memory zip file
-    memory_file = io.BytesIO()
-    with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-        # Path to commission folder
-        commission_folder = os.path.join('static/uploads/commissions', str(commission_id))
-
-        # Add original files
-        original_folder = os.path.join(commission_folder, 'original')
-        if os.path.exists(original_folder):
-            for file in os.listdir(original_folder):
-                file_path = os.path.join(original_folder, file)
-                if os.path.isfile(file_path):
-                    # Add file to zip with path inside zip
-                    zf.write(file_path, os.path.join('original', file))
-
-        # Add watermarked files
-        watermarked_folder = os.path.join(commission_folder, 'watermarked')
-        if os.path.exists(watermarked_folder):
-            for file in os.listdir(watermarked_folder):
-                file_path = os.path.join(watermarked_folder, file)
-                if os.path.isfile(file_path):
-                    # Add file to zip with path inside zip
-                    zf.write(file_path, os.path.join('watermarked', file))
-
-    # Reset file pointer
-    memory_file.seek(0)
-
     # Create zip filename
     zip_filename = f"{commission['title']} - Commission Files.zip"
 
-    return Response(
-        memory_file.getvalue(),
-        mimetype='application/zip',
-        headers={'Content-Disposition': f'attachment; filename="{zip_filename}"'}
-    )
+    # Served from the archive cache when built, which allows resuming with Range
+    return send_archive(get_commission_archive_entries(commission_id), zip_filename,
+                        prebuild={'commission_id': commission_id})
+
+# Archive entries for references, organized by category and subcategory
+def get_reference_archive_entries(references):
+    entries = {}
+    for ref in references:
+        category = ref['category']
+        subcategory = ref['subcategory']
+        filename = ref['filename']
+
+        # Create path within zip file
+        zip_path = f"{category}/{subcategory}/{filename}"
+
+        # Get file path on disk
+        file_path = os.path.join('static/uploads/references', filename)
+
+        # Add file to zip if it exists
+        if zip_path not in entries and os.path.exists(file_path):
+            entries[zip_path] = ArchiveEntry(file_path, zip_path)
+
+    # Sorted so the same set of references always gives the same archive (and cache key)
+    return [entries[zip_path] for zip_path in sorted(entries)]
+
+# Original and watermarked files of a commission, in a fixed order
+def get_commission_archive_entries(commission_id):
+    commission_folder = os.path.join('static/uploads/commissions', str(commission_id))
+    entries = []
+    for subfolder in ('original', 'watermarked'):
+        folder = os.path.join(commission_folder, subfolder)
+        if not os.path.isdir(folder):
+            continue
+        for file in sorted(os.listdir(folder)):
+            file_path = os.path.join(folder, file)
+            if os.path.isfile(file_path):
+                # Stored uncompressed so the archive size is known up front
+                entries.append(ArchiveEntry(file_path, f"{subfolder}/{file}", compress=False))
+    return entries
+
+# Send an archive of entries. prebuild is the payload of a build_archive job
+# to queue when it isn't cached yet, so the next visitors get the cached copy.
+def send_archive(entries, zip_filename, prebuild=None):
+    key = archive_key(entries)
+    last_modified = max((entry.mtime for entry in entries), default=None)
+
+    # Serve the prebuilt archive when there is one
+    cached_path = get_cached_archive(entries)
+    if cached_path:
+        return send_file(cached_path, mimetype='application/zip', as_attachment=True,
+                         download_name=zip_filename, etag=key, last_modified=last_modified)
+
+    # Otherwise stream it, and build it for the next visitors if asked to
+    if prebuild:
+        jobs.enqueue('build_archive', prebuild, unique=True)
+
+    response = Response(stream_zip(entries), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=zip_filename)
+    # Known in advance when every entry is stored uncompressed
+    size = archive_size(entries)
+    if size is not None:
+        response.content_length = size
+    # Archives are deterministic, so the content key is a valid ETag
+    response.set_etag(key)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response.make_conditional(request)
+
+# Build the "download all" archive of a custom reference in the background
+def prebuild_custom_reference_archive(custom_ref_id):
+    jobs.enqueue('build_archive', {'custom_ref_id': custom_ref_id}, unique=True)
+
+# Build a commission's folder archive in the background
+def prebuild_commission_archive(commission_id):
+    jobs.enqueue('build_archive', {'commission_id': commission_id}, unique=True)
+
+# Build a commission's folder archive, from a job
+def build_commission_archive(commission_id):
+    entries = get_commission_archive_entries(commission_id)
+    if entries:
+        build_cached_archive(entries)
+
+# Build the cached archive of a custom reference or a commission
+@jobs.job_handler('build_archive')
+def build_archive(payload, report_progress):
+    if 'custom_ref_id' in payload:
+        entries = get_reference_archive_entries(db.get_references_for_custom_ref(payload['custom_ref_id']))
+        if entries:
+            build_cached_archive(entries)
+    else:
+        build_commission_archive(payload['commission_id'])
+
+@app.route('/custom_reference/<link_id>/download')
+def download_custom_reference(link_id):
+    custom_ref = db.get_custom_reference_by_link_id(link_id)
+
+    if not custom_ref:
+        flash('Custom reference link not found')
+        return redirect(url_for('index'))
+
+    entries = get_reference_archive_entries(db.get_references_for_custom_ref(custom_ref['id']))
+
+    if not entries:
+        flash('No valid references found')
+        return redirect(url_for('custom_reference', link_id=link_id))
+
+    zip_filename = f"{db.get_site_title()} References - {custom_ref['name']}.zip"
+    return send_archive(entries, zip_filename, prebuild={'custom_ref_id': custom_ref['id']})
 
 # Download references as zip
 @app.route('/download_references_zip', methods=['GET', 'POST'])
@@ -890,6 +1557,12 @@ def download_references_zip():
         reference_ids = request.json.get('reference_ids', [])
         custom_ref_name = request.json.get('custom_ref_name', None)
 
+        # "Download all" covers every page of the current filter, not only the loaded cards
+        if request.json.get('all'):
+            reference_ids = db.get_reference_ids(include_private=is_authenticated(),
+                                                 category=request.json.get('category') or None,
+                                                 subcategory=request.json.get('subcategory') or None)
+
         # If no reference IDs provided, return error
         if not reference_ids:
             return jsonify({'error': 'No references selected'}), 400
@@ -903,59 +1576,35 @@ def download_references_zip():
                     'download_url': url_for('static', filename=f'uploads/references/{ref["filename"]}')
                 })
 
-        # Store reference IDs and custom ref name in session for GET request
-        session['download_reference_ids'] = reference_ids
-        session['download_custom_ref_name'] = custom_ref_name
+        # Store the selection server-side; the GET request only carries its token
+        try:
+            token = db.create_download_token(reference_ids, custom_ref_name)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid reference selection'}), 400
 
         # Return success response
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'download_url': url_for('download_references_zip', token=token)})
 
     else:  # GET request
-        # Get reference IDs and custom ref name from session
-        reference_ids = session.get('download_reference_ids', [])
-        custom_ref_name = session.get('download_custom_ref_name', None)
-
-        # Clear session data
-        session.pop('download_reference_ids', None)
-        session.pop('download_custom_ref_name', None)
+        # Get reference IDs and custom ref name stored under the token
+        selection = db.get_download_token(request.args.get('token', ''))
 
-        # If no reference IDs provided, return error
-        if not reference_ids:
+        # If the token is unknown or expired, return error
+        if not selection or not selection['reference_ids']:
             flash('No references selected for download')
             return redirect(url_for('references'))
 
+        reference_ids = selection['reference_ids']
+        custom_ref_name = selection['custom_ref_name']
+
         # Get references from database
-        references = []
-        for ref_id in reference_ids:
-            ref = db.get_reference_by_id(ref_id)
-            if ref:
-                references.append(ref)
+        references = db.get_references_by_ids(reference_ids)
 
         if not references:
             flash('No valid references found')
             return redirect(url_for('references'))
 
-        # Create in-memory zip file
-        memory_file = io.BytesIO()
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            # Organize references by category and subcategory
-            for ref in references:
-                category = ref['category']
-                subcategory = ref['subcategory']
-                filename = ref['filename']
-
-                # Create path within zip file
-                zip_path = f"{category}/{subcategory}/{filename}"
-
-                # Get file path on disk
-                file_path = os.path.join('static/uploads/references', filename)
-
-                # Add file to zip if it exists
-                if os.path.exists(file_path):
-                    zf.write(file_path, zip_path)
-
-        # Reset file pointer
-        memory_file.seek(0)
+        entries = get_reference_archive_entries(references)
 
         # Get site title for zip filename
         site_title = db.get_site_title()
@@ -967,13 +1616,7 @@ def download_references_zip():
             current_date = datetime.now().strftime('%Y-%m-%d')
             zip_filename = f"{site_title} References - {current_date}.zip"
 
-        return Response(
-            memory_file.getvalue(),
-            mimetype='application/zip',
-            headers={
-                'Content-Disposition': f'attachment; filename="{zip_filename}"'
-            }
-        )
+        return send_archive(entries, zip_filename)
 
 # This app object is used by Gunicorn. To run with Gunicorn:
 # gunicorn -c gunicorn_config.py app:app
@@ -993,6 +1636,10 @@ if __name__ == '__main__':
         port = 443
         use_ssl = True
 
+    # Run background jobs in the reloader's serving process, not in its watcher
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        jobs.start_worker_thread()
+
     if use_ssl:
         context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
         try:
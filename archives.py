@@ -0,0 +1,314 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+# Formats that are already compressed; deflating them only costs CPU
+STORED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.webp', '.gif', '.avif', '.heic', '.heif',
+    '.zip', '.7z', '.rar', '.gz', '.mp4', '.webm', '.mov', '.mp3',
+}
+
+# Bytes read from disk per chunk of the response
+CHUNK_SIZE = 1024 * 1024
+
+# Prebuilt archives, named after a hash of their content
+ARCHIVE_CACHE_DIR = os.path.join('cache', 'archives')
+# Least recently used archives are evicted past this total size
+ARCHIVE_CACHE_MAX_BYTES = 2 * 1024 ** 3
+# Seconds without a write after which a partial archive is left over from a
+# build that was killed, and is deleted
+ARCHIVE_TMP_MAX_AGE = 3600
+
+# Same conservative limit as zipfile: past it, entries use ZIP64 fields
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_FILECOUNT_LIMIT = (1 << 16) - 1
+
+# General purpose flags: names are UTF-8, and sizes follow the data
+_FLAG_UTF8 = 0x800
+_FLAG_DATA_DESCRIPTOR = 0x08
+
+# Keys of archives being built by this process
+_building = set()
+_building_lock = threading.Lock()
+
+class ArchiveEntry:
+    """
+    A file on disk and the name it gets inside the archive.
+    """
+    __slots__ = ('path', 'arcname', 'size', 'mtime', 'compress')
+
+    def __init__(self, path, arcname, compress=None):
+        stat = os.stat(path)
+        self.path = path
+        self.arcname = arcname
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.compress = should_compress(arcname) if compress is None else compress
+
+    @property
+    def zip64(self):
+        # Decided from the file size alone so the layout is known in advance
+        return self.size * 1.05 > ZIP64_LIMIT
+
+def should_compress(filename):
+    return os.path.splitext(filename)[1].lower() not in STORED_EXTENSIONS
+
+def _flags(entry):
+    # Only deflated entries need a data descriptor: a stored entry's CRC is
+    # computed before its header, as streaming readers such as Java's
+    # ZipInputStream reject stored entries followed by a descriptor
+    return _FLAG_UTF8 | (_FLAG_DATA_DESCRIPTOR if entry.compress else 0)
+
+def _file_crc(path, size):
+    """
+    CRC-32 of the first size bytes of path.
+    """
+    crc = 0
+    remaining = size
+    with open(path, 'rb') as f:
+        while remaining:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise OSError(f"{path} shrank while it was being archived")
+            remaining -= len(chunk)
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+def _dos_datetime(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+def _local_header(entry, crc=0):
+    """
+    Local file header of entry. Deflated entries leave the CRC and sizes to
+    their data descriptor; stored ones carry the given crc and their size.
+    """
+    name = entry.arcname.encode('utf-8')
+    dos_time, dos_date = _dos_datetime(entry.mtime)
+    method = zlib.DEFLATED if entry.compress else 0
+    size = 0 if entry.compress else entry.size
+    if entry.compress:
+        crc = 0
+    if entry.zip64:
+        extra = struct.pack('<HHQQ', 1, 16, size, size)
+        version, sizes = 45, 0xFFFFFFFF
+    else:
+        extra = b''
+        version, sizes = 20, size
+    return struct.pack('<IHHHHHIIIHH', 0x04034b50, version, _flags(entry), method, dos_time, dos_date,
+                       crc, sizes, sizes, len(name), len(extra)) + name + extra
+
+def _data_descriptor(entry, crc, compress_size):
+    # Only written after deflated entries
+    fmt = '<IIQQ' if entry.zip64 else '<IIII'
+    return struct.pack(fmt, 0x08074b50, crc, compress_size, entry.size)
+
+def _central_header(entry, crc, compress_size, header_offset):
+    name = entry.arcname.encode('utf-8')
+    dos_time, dos_date = _dos_datetime(entry.mtime)
+    method = zlib.DEFLATED if entry.compress else 0
+
+    # ZIP64 extra holds whichever of the three values don't fit in 32 bits
+    zip64_fields = []
+    file_size, size_field = entry.size, entry.size
+    if file_size > ZIP64_LIMIT:
+        zip64_fields.append(file_size)
+        size_field = 0xFFFFFFFF
+    compress_field = compress_size
+    if compress_size > ZIP64_LIMIT:
+        zip64_fields.append(compress_size)
+        compress_field = 0xFFFFFFFF
+    offset_field = header_offset
+    if header_offset > ZIP64_LIMIT:
+        zip64_fields.append(header_offset)
+        offset_field = 0xFFFFFFFF
+    extra = b''
+    if zip64_fields:
+        extra = struct.pack(f'<HH{len(zip64_fields)}Q', 1, 8 * len(zip64_fields), *zip64_fields)
+    version = 45 if zip64_fields or entry.zip64 else 20
+
+    return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, version, version, _flags(entry), method,
+                       dos_time, dos_date, crc, compress_field, size_field, len(name), len(extra),
+                       0, 0, 0, 0o100644 << 16, offset_field) + name + extra
+
+def _end_records(count, central_size, central_offset):
+    records = b''
+    if count > ZIP_FILECOUNT_LIMIT or central_size > ZIP64_LIMIT or central_offset > ZIP64_LIMIT:
+        zip64_end_offset = central_offset + central_size
+        records += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0,
+                               count, count, central_size, central_offset)
+        records += struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1)
+    records += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0,
+                           min(count, 0xFFFF), min(count, 0xFFFF),
+                           min(central_size, 0xFFFFFFFF), min(central_offset, 0xFFFFFFFF), 0)
+    return records
+
+def archive_size(entries):
+    """
+    Exact size in bytes of the archive stream_zip produces for entries, or
+    None if any entry is deflated (its compressed size isn't known ahead).
+    """
+    if any(entry.compress for entry in entries):
+        return None
+
+    offset = 0
+    central_size = 0
+    for entry in entries:
+        header_offset = offset
+        offset += len(_local_header(entry)) + entry.size
+        central_size += len(_central_header(entry, 0, entry.size, header_offset))
+    return offset + central_size + len(_end_records(len(entries), central_size, offset))
+
+def stream_zip(entries):
+    """
+    Generate a ZIP archive of entries chunk by chunk, without holding more
+    than one chunk in memory. Compressible files are deflated, the others
+    stored as is.
+    """
+    offset = 0
+    central_directory = []
+
+    for entry in entries:
+        # Stored entries are read twice: once for the CRC in their header
+        expected_crc = None if entry.compress else _file_crc(entry.path, entry.size)
+        header = _local_header(entry, expected_crc or 0)
+        header_offset = offset
+        offset += len(header)
+        yield header
+
+        crc = 0
+        compress_size = 0
+        remaining = entry.size
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15) if entry.compress else None
+        with open(entry.path, 'rb') as f:
+            # Never read past the size the headers were computed for
+            while remaining:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise OSError(f"{entry.path} shrank while it was being archived")
+                remaining -= len(chunk)
+                crc = zlib.crc32(chunk, crc)
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    compress_size += len(chunk)
+                    yield chunk
+            if compressor:
+                chunk = compressor.flush()
+                compress_size += len(chunk)
+                yield chunk
+
+        offset += compress_size
+        if entry.compress:
+            descriptor = _data_descriptor(entry, crc, compress_size)
+            offset += len(descriptor)
+            yield descriptor
+        elif crc != expected_crc:
+            raise OSError(f"{entry.path} changed while it was being archived")
+        central_directory.append(_central_header(entry, crc, compress_size, header_offset))
+
+    central = b''.join(central_directory)
+    yield central
+    yield _end_records(len(central_directory), len(central), offset)
+
+def archive_key(entries):
+    """
+    Hash of the archive's layout and of each file's version. Archives are
+    deterministic, so equal keys mean byte-identical archives.
+    """
+    digest = hashlib.sha256()
+    for entry in entries:
+        digest.update(json.dumps([entry.arcname, entry.size, entry.mtime, entry.compress]).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def _cached_archive_path(key):
+    return os.path.join(ARCHIVE_CACHE_DIR, f'{key}.zip')
+
+def get_cached_archive(entries):
+    """
+    Return the path of the prebuilt archive for entries, or None.
+    """
+    path = _cached_archive_path(archive_key(entries))
+    try:
+        # Mark as recently used for LRU eviction
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return path
+
+def build_cached_archive(entries):
+    """
+    Write the archive for entries into the cache, unless it is already
+    there, then evict old archives. Returns the archive's path.
+    """
+    key = archive_key(entries)
+    path = _cached_archive_path(key)
+    with _building_lock:
+        if key in _building or os.path.exists(path):
+            return path
+        _building.add(key)
+
+    try:
+        os.makedirs(ARCHIVE_CACHE_DIR, exist_ok=True)
+        # Build under a temporary name so readers never see a partial archive
+        fd, tmp_path = tempfile.mkstemp(dir=ARCHIVE_CACHE_DIR, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in stream_zip(entries):
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    finally:
+        with _building_lock:
+            _building.discard(key)
+
+    evict_archive_cache()
+    return path
+
+def evict_archive_cache(max_bytes=ARCHIVE_CACHE_MAX_BYTES):
+    """
+    Delete least recently used archives until the cache fits in max_bytes,
+    and partial archives of builds that died.
+    """
+    try:
+        names = os.listdir(ARCHIVE_CACHE_DIR)
+    except FileNotFoundError:
+        return
+
+    cached = []
+    now = time.time()
+    for name in names:
+        if not name.endswith(('.zip', '.tmp')):
+            continue
+        path = os.path.join(ARCHIVE_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+            if name.endswith('.tmp'):
+                if now - stat.st_mtime > ARCHIVE_TMP_MAX_AGE:
+                    os.remove(path)
+                continue
+        except FileNotFoundError:
+            continue
+        cached.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in cached)
+    for _, size, path in sorted(cached):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -1,42 +1,232 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import secrets
 import sqlite3
+import threading
 from datetime import datetime
 
+from flask import g, has_app_context
+
+DATABASE = 'gallery.db'
+
+# Number of references per page of the public listing
+REFERENCES_PAGE_SIZE = 60
+# Number of results per page of the search endpoint
+SEARCH_PAGE_SIZE = 20
+# Ids per IN (...) query, well under SQLite's bound parameter limit
+ID_CHUNK_SIZE = 500
+# Seconds a zip download token stays valid
+DOWNLOAD_TOKEN_TTL = 3600
+# Background jobs: attempts before a job is marked failed, and seconds a
+# running job may go without progress before another worker takes it over
+JOB_MAX_ATTEMPTS = 3
+JOB_LEASE_SECONDS = 600
+# processing value of uploads whose job used all its attempts; they stay
+# hidden like those still being processed (1)
+PROCESSING_FAILED = 2
+
+# Connection tuning, applied once when a pooled connection is opened
+POOL_SIZE = 4
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KIB = 16384
+MMAP_SIZE = 128 * 1024 * 1024
+CACHED_STATEMENTS = 256
+
+# Idle connections of the current worker process
+_pool = []
+_pool_pid = None
+_pool_lock = threading.Lock()
+# Connections inherited from a parent process, kept alive so they are never
+# closed (and checkpointed) from the forked child
+_inherited = []
+# Connection used outside of a Flask app context (startup, scripts)
+_local = threading.local()
+
+# Per-worker settings cache, validated against PRAGMA data_version
+_settings = None
+_settings_data_version = None
+_settings_lock = threading.Lock()
+_settings_watch = (None, None)
+
+def _open_connection():
+    conn = sqlite3.connect(DATABASE, timeout=BUSY_TIMEOUT_MS / 1000,
+                           cached_statements=CACHED_STATEMENTS, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    # WAL lets public readers keep going while the dashboard writes
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    conn.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KIB}')
+    conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    # Off by default in SQLite; the schema's ON DELETE CASCADE relies on it
+    conn.execute('PRAGMA foreign_keys = ON')
+    return conn
+
+def _acquire_connection():
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            # Forked worker: never reuse the parent's connections
+            _inherited.extend(_pool)
+            _pool = []
+            _pool_pid = os.getpid()
+        if _pool:
+            return _pool.pop()
+    return _open_connection()
+
+def _release_connection(conn):
+    with _pool_lock:
+        if _pool_pid == os.getpid() and len(_pool) < POOL_SIZE:
+            _pool.append(conn)
+            return
+    conn.close()
+
 # Database connection helper
 def get_db_connection():
-    conn = sqlite3.connect('gallery.db')
-    conn.row_factory = sqlite3.Row
+    """
+    Return the connection bound to the current app context, checking one out
+    of the worker's pool on first use. Outside of an app context a
+    per-thread connection is used instead.
+    """
+    if has_app_context():
+        if 'db_conn' not in g:
+            g.db_conn = _acquire_connection()
+        return g.db_conn
+
+    pid, conn = getattr(_local, 'conn', (None, None))
+    if pid != os.getpid():
+        if conn is not None:
+            _inherited.append(conn)
+        conn = _acquire_connection()
+        _local.conn = (os.getpid(), conn)
     return conn
 
-# Helper function to convert date strings to datetime objects
-def convert_date_fields(data, date_fields):
-    if data is None:
-        return None
+def close_db_connection(exception=None):
+    """
+    Return the app context's connection to the pool. Registered as a
+    teardown_appcontext handler.
+    """
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        # Discard writes a failed request left uncommitted, so the next
+        # commit on this pooled connection can't persist them
+        if exception is not None or conn.in_transaction:
+            conn.rollback()
+        _release_connection(conn)
+
+def close_all_connections():
+    """
+    Close every connection held by this process. Called after startup work
+    so no connection is open when gunicorn forks its workers.
+    """
+    global _pool, _settings_watch, _settings, _settings_data_version
+    with _pool_lock:
+        idle, _pool = _pool, []
+    pid, conn = getattr(_local, 'conn', (None, None))
+    if conn is not None and pid == os.getpid():
+        idle.append(conn)
+    _local.conn = (None, None)
+    with _settings_lock:
+        pid, conn = _settings_watch
+        if conn is not None and pid == os.getpid():
+            idle.append(conn)
+        _settings_watch = (None, None)
+        # The next watch connection starts a new data_version baseline
+        _settings = None
+        _settings_data_version = None
+    for conn in idle:
+        conn.close()
 
-    result = dict(data)
-    for field in date_fields:
-        if field in result and result[field] is not None:
-            # If it's already a datetime object, no need to convert
-            if isinstance(result[field], datetime):
-                continue
-
-            try:
-                # Try different date formats
-                date_formats = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
-                for date_format in date_formats:
-                    try:
-                        result[field] = datetime.strptime(result[field], date_format)
-                        break
-                    except ValueError:
-                        continue
-            except (TypeError):
-                # If conversion fails, keep the original value
-                pass
-    return result
+# Date columns of each table, parsed lazily by Record
+REFERENCE_DATE_FIELDS = ('upload_date',)
+CUSTOM_REFERENCE_DATE_FIELDS = ('creation_date',)
+COMMISSION_DATE_FIELDS = ('commission_date',)
 
-def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+def _parse_timestamp(value):
+    if isinstance(value, datetime):
+        return value
+    try:
+        # Handles both 'YYYY-MM-DD HH:MM:SS' and 'YYYY-MM-DD'
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        # If conversion fails, keep the original value
+        return value
 
+class Record:
+    """
+    Compact, dict-like wrapper around a sqlite3.Row.
+
+    Supports item and attribute access like the dicts it replaces. Date
+    columns are only parsed when read, and extra keys (e.g. 'images') can be
+    assigned. Use dict(record) where a real dict is needed, such as jsonify.
+    """
+    __slots__ = ('_row', '_date_fields', '_values')
+
+    def __init__(self, row, date_fields=()):
+        self._row = row
+        self._date_fields = date_fields
+        # Parsed dates and assigned keys, allocated on first use
+        self._values = None
+
+    def __getitem__(self, key):
+        values = self._values
+        if values is not None and key in values:
+            return values[key]
+        try:
+            value = self._row[key]
+        except IndexError:
+            raise KeyError(key) from None
+        if value is not None and key in self._date_fields:
+            value = _parse_timestamp(value)
+            self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if self._values is None:
+            self._values = {}
+        self._values[key] = value
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __contains__(self, key):
+        return key in self._row.keys() or (self._values is not None and key in self._values)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return f"Record({dict(self)!r})"
+
+    def keys(self):
+        keys = self._row.keys()
+        if self._values:
+            keys = keys + [key for key in self._values if key not in keys]
+        return keys
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version.
+# Append new migrations to MIGRATIONS; never edit one that has shipped.
+def _migration_base_schema(cursor):
     # Create admin table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS [admin] (
@@ -135,37 +325,333 @@ def init_db():
     )
     ''')
 
-    conn.commit()
-    conn.close()
+def _migration_listing_indexes(cursor):
+    # Indexes for the public listings and the junction table lookups
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS [idx_references_public_category]
+    ON [references] (public, category, subcategory)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS [idx_commission_images_commission]
+    ON [commission_images] (commission_id, display_order)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS [idx_custom_reference_items_custom_ref]
+    ON [custom_reference_items] (custom_ref_id)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS [idx_custom_reference_items_reference]
+    ON [custom_reference_items] (reference_id)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS [idx_commissions_public_date]
+    ON [commissions] (public, commission_date)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS [idx_commissions_artist]
+    ON [commissions] (artist_id)
+    ''')
 
-# Admin related functions
-def is_setup_complete():
+def _migration_unique_custom_reference_items(cursor):
+    # Drop duplicate memberships before enforcing uniqueness
+    cursor.execute('''
+    DELETE FROM [custom_reference_items]
+    WHERE id NOT IN (
+        SELECT MIN(id) FROM [custom_reference_items]
+        GROUP BY custom_ref_id, reference_id
+    )
+    ''')
+    # The unique index also serves lookups by custom_ref_id alone
+    cursor.execute('DROP INDEX IF EXISTS [idx_custom_reference_items_custom_ref]')
+    cursor.execute('''
+    CREATE UNIQUE INDEX IF NOT EXISTS [idx_custom_reference_items_unique]
+    ON [custom_reference_items] (custom_ref_id, reference_id)
+    ''')
+
+def _migration_reference_category_index(cursor):
+    # Serves the logged-in listing (no public filter) and category facets
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS [idx_references_category]
+    ON [references] (category, subcategory)
+    ''')
+
+# Kinds of rows in the search index. A row's FTS rowid is id * 4 + kind,
+# so triggers can update it by rowid without scanning the index.
+SEARCH_KIND_REFERENCE = 1
+SEARCH_KIND_COMMISSION = 2
+SEARCH_KIND_ARTIST = 3
+SEARCH_KINDS = {
+    SEARCH_KIND_REFERENCE: 'reference',
+    SEARCH_KIND_COMMISSION: 'commission',
+    SEARCH_KIND_ARTIST: 'artist',
+}
+
+def _migration_search_index(cursor):
+    # Full-text index over references, commissions and artists
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS [search_index] USING fts5(
+        title, body, tags,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )
+    ''')
+
+    sources = {
+        'references': (SEARCH_KIND_REFERENCE, 'COALESCE({row}.name, {row}.filename)', '{row}.description',
+                       "{row}.category || ' ' || {row}.subcategory", 'name, filename, description, category, subcategory'),
+        'commissions': (SEARCH_KIND_COMMISSION, '{row}.title', '{row}.description', "''", 'title, description'),
+        'artists': (SEARCH_KIND_ARTIST, '{row}.name', '{row}.notes', "''", 'name, notes'),
+    }
+    for table, (kind, title, body, tags, columns) in sources.items():
+        new_values = ', '.join(expr.format(row='new') for expr in (title, body, tags))
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS [{table}_search_insert] AFTER INSERT ON [{table}] BEGIN
+            INSERT INTO [search_index] (rowid, title, body, tags) VALUES (new.id * 4 + {kind}, {new_values});
+        END
+        ''')
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS [{table}_search_update] AFTER UPDATE OF {columns} ON [{table}] BEGIN
+            UPDATE [search_index]
+            SET title = {title.format(row='new')}, body = {body.format(row='new')}, tags = {tags.format(row='new')}
+            WHERE rowid = old.id * 4 + {kind};
+        END
+        ''')
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS [{table}_search_delete] AFTER DELETE ON [{table}] BEGIN
+            DELETE FROM [search_index] WHERE rowid = old.id * 4 + {kind};
+        END
+        ''')
+        # Index the rows that already exist
+        existing_values = ', '.join(expr.format(row=f'[{table}]') for expr in (title, body, tags))
+        cursor.execute(f'''
+        INSERT INTO [search_index] (rowid, title, body, tags)
+        SELECT [{table}].id * 4 + {kind}, {existing_values} FROM [{table}]
+        ''')
+
+def _migration_download_tokens(cursor):
+    # Reference selections waiting to be downloaded as a zip
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS [download_tokens] (
+        token TEXT PRIMARY KEY,
+        selection_key TEXT NOT NULL,
+        reference_ids TEXT NOT NULL,
+        custom_ref_name TEXT,
+        expires_at TIMESTAMP NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS [idx_download_tokens_selection]
+    ON [download_tokens] (selection_key)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS [idx_download_tokens_expires]
+    ON [download_tokens] (expires_at)
+    ''')
+
+# Owners of responsive image copies
+DERIVATIVE_KIND_REFERENCE = 'reference'
+DERIVATIVE_KIND_COMMISSION_IMAGE = 'commission_image'
+
+def _migration_image_derivatives(cursor):
+    # Resized copies of references and commission images, for srcset
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS [image_derivatives] (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        owner_id INTEGER NOT NULL,
+        width INTEGER NOT NULL,
+        height INTEGER NOT NULL,
+        format TEXT NOT NULL,
+        path TEXT NOT NULL,
+        UNIQUE (kind, owner_id, format, width)
+    )
+    ''')
+
+    owners = {
+        'references': DERIVATIVE_KIND_REFERENCE,
+        'commission_images': DERIVATIVE_KIND_COMMISSION_IMAGE,
+    }
+    for table, kind in owners.items():
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS [{table}_derivatives_delete] AFTER DELETE ON [{table}] BEGIN
+            DELETE FROM [image_derivatives] WHERE kind = '{kind}' AND owner_id = old.id;
+        END
+        ''')
+
+def _migration_watermark_settings(cursor):
+    # Kept originals and the settings their watermarked copies were made with
+    for table in ('references', 'commission_images'):
+        cursor.execute(f'ALTER TABLE [{table}] ADD COLUMN original_filename TEXT')
+        cursor.execute(f'ALTER TABLE [{table}] ADD COLUMN watermark_text TEXT')
+        cursor.execute(f'ALTER TABLE [{table}] ADD COLUMN watermark_opacity INTEGER')
+        cursor.execute(f'ALTER TABLE [{table}] ADD COLUMN watermark_angle INTEGER')
+    cursor.execute('ALTER TABLE [commission_images] ADD COLUMN watermarked BOOLEAN DEFAULT 0')
+    cursor.execute('''
+    UPDATE [commission_images] SET watermarked = 1 WHERE filename LIKE '%/watermarked/%'
+    ''')
+
+def _migration_jobs(cursor):
+    # Background jobs, run by worker.py
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS [jobs] (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        progress REAL NOT NULL DEFAULT 0,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL,
+        error TEXT,
+        run_after TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        locked_by TEXT,
+        locked_at TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS [idx_jobs_status_run_after]
+    ON [jobs] (status, run_after)
+    ''')
+
+    # Uploads whose images are still being processed by a job
+    cursor.execute('ALTER TABLE [references] ADD COLUMN processing BOOLEAN DEFAULT 0')
+    cursor.execute('ALTER TABLE [commission_images] ADD COLUMN processing BOOLEAN DEFAULT 0')
+
+def _migration_job_details(cursor):
+    # Counters reported by a running job, as JSON
+    cursor.execute('ALTER TABLE [jobs] ADD COLUMN details TEXT')
+
+def _migration_miniature_size(cursor):
+    # Longest side of reference miniatures; NULL uses the default
+    cursor.execute('ALTER TABLE [admin] ADD COLUMN miniature_size INTEGER')
+
+def _migration_foreign_key_orphans(cursor):
+    # Rows whose parent was deleted while foreign keys were not enforced
+    cursor.execute('''
+    DELETE FROM [custom_reference_items]
+    WHERE custom_ref_id NOT IN (SELECT id FROM [custom_references])
+       OR reference_id NOT IN (SELECT id FROM [references])
+    ''')
+    cursor.execute('''
+    DELETE FROM [commission_images]
+    WHERE commission_id NOT IN (SELECT id FROM [commissions])
+    ''')
+    cursor.execute('''
+    UPDATE [commissions] SET custom_ref_id = NULL
+    WHERE custom_ref_id NOT IN (SELECT id FROM [custom_references])
+    ''')
+
+MIGRATIONS = [
+    _migration_base_schema,
+    _migration_listing_indexes,
+    _migration_unique_custom_reference_items,
+    _migration_reference_category_index,
+    _migration_search_index,
+    _migration_download_tokens,
+    _migration_image_derivatives,
+    _migration_watermark_settings,
+    _migration_jobs,
+    _migration_job_details,
+    _migration_miniature_size,
+    _migration_foreign_key_orphans,
+]
+
+def init_db():
+    """
+    Create the database or bring an existing one up to the latest schema
+    version. Safe to call on every startup.
+    """
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT setup_complete FROM [admin] LIMIT 1')
-    result = cursor.fetchone()
-    conn.close()
-    return result and result[0] == 1
+
+    # Take the write lock first so concurrent workers migrate one at a time
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        for index, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            migration(cursor)
+            cursor.execute(f'PRAGMA user_version = {index}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+# Admin related functions
+def _get_data_version():
+    # A dedicated connection per process: its data_version changes whenever
+    # any other connection, in this worker or another one, commits.
+    # Called with _settings_lock held.
+    global _settings_watch, _settings, _settings_data_version
+    pid, conn = _settings_watch
+    if pid != os.getpid():
+        conn = _open_connection()
+        _settings_watch = (os.getpid(), conn)
+        # data_version only compares within one connection: a new one starts
+        # from its own baseline, which may equal the cached version
+        _settings = None
+        _settings_data_version = None
+    return conn.execute('PRAGMA data_version').fetchone()[0]
+
+def get_settings():
+    """
+    Return the site settings (admin row without the password), loaded once
+    per worker and reloaded only after the database has been written to.
+    Any commit counts, not only ones to the admin table (job progress,
+    download tokens...): the reload is a single-row read, cheaper than
+    telling the writes apart.
+    """
+    global _settings, _settings_data_version
+    if has_app_context() and 'settings' in g:
+        return g.settings
+
+    with _settings_lock:
+        # Read the version before the row so a concurrent commit is never missed
+        data_version = _get_data_version()
+        if _settings is None or data_version != _settings_data_version:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute('SELECT site_title, setup_complete, contact_link, miniature_size FROM [admin] LIMIT 1')
+            result = cursor.fetchone()
+            _settings = dict(result) if result else {}
+            _settings_data_version = data_version
+        settings = _settings
+
+    if has_app_context():
+        g.settings = settings
+    return settings
+
+def invalidate_settings_cache():
+    global _settings
+    with _settings_lock:
+        _settings = None
+    if has_app_context():
+        g.pop('settings', None)
+
+def is_setup_complete():
+    return get_settings().get('setup_complete') == 1
 
 def get_site_title():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT site_title FROM [admin] LIMIT 1')
-    result = cursor.fetchone()
-    conn.close()
-    return result['site_title'] if result else 'Art Commission Gallery'
+    return get_settings().get('site_title') or 'Art Commission Gallery'
 
 def get_footer_text():
     # Return a fixed string as per requirements
     return 'Made with ❤️ by Fuyucchi'
 
 def get_contact_link():
+    return get_settings().get('contact_link') or ''
+
+def get_miniature_size():
+    # None until one is chosen
+    return get_settings().get('miniature_size')
+
+def update_miniature_size(size):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT contact_link FROM [admin] LIMIT 1')
-    result = cursor.fetchone()
-    conn.close()
-    return result['contact_link'] if result and result['contact_link'] else ''
+    cursor.execute('UPDATE [admin] SET miniature_size = ?', (size,))
+    conn.commit()
+    invalidate_settings_cache()
+    return True
 
 def complete_setup(username, password, site_title):
     from werkzeug.security import generate_password_hash
@@ -176,7 +662,7 @@ def complete_setup(username, password, site_title):
     cursor.execute('INSERT INTO [admin] (username, password, site_title, setup_complete) VALUES (?, ?, ?, 1)',
                   (username, hashed_password, site_title))
     conn.commit()
-    conn.close()
+    invalidate_settings_cache()
     return True
 
 def authenticate_user(username, password):
@@ -186,7 +672,6 @@ def authenticate_user(username, password):
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM [admin] WHERE username = ?', (username,))
     admin = cursor.fetchone()
-    conn.close()
 
     if admin and check_password_hash(admin['password'], password):
         return True
@@ -209,10 +694,19 @@ def update_settings(site_title=None, new_password=None, contact_link=None):
         cursor.execute('UPDATE [admin] SET contact_link = ?', (contact_link,))
 
     conn.commit()
-    conn.close()
+    invalidate_settings_cache()
     return True
 
 # Reference related functions
+def organize_references(references):
+    """
+    Group references by category and subcategory, keeping their order.
+    """
+    organized_refs = {}
+    for ref in references:
+        organized_refs.setdefault(ref['category'], {}).setdefault(ref['subcategory'], []).append(ref)
+    return organized_refs
+
 def get_organized_references(include_private=False):
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -220,26 +714,92 @@ def get_organized_references(include_private=False):
     if include_private:
         cursor.execute('SELECT * FROM [references] ORDER BY category, subcategory')
     else:
-        cursor.execute('SELECT * FROM [references] WHERE public = 1 ORDER BY category, subcategory')
-
-    references = cursor.fetchall()
-
-    # Organize references by category and subcategory
-    organized_refs = {}
-    for ref in references:
-        category = ref['category']
-        subcategory = ref['subcategory']
-
-        if category not in organized_refs:
-            organized_refs[category] = {}
+        # References still being processed are published once they are done
+        cursor.execute('SELECT * FROM [references] WHERE public = 1 AND processing = 0 ORDER BY category, subcategory')
+
+    return organize_references([Record(row, REFERENCE_DATE_FIELDS) for row in cursor.fetchall()])
+
+def _reference_filters(include_private, category, subcategory):
+    clauses = []
+    params = []
+    if not include_private:
+        clauses.append('public = 1 AND processing = 0')
+    if category is not None:
+        clauses.append('category = ?')
+        params.append(category)
+    if subcategory is not None:
+        clauses.append('subcategory = ?')
+        params.append(subcategory)
+    return clauses, params
+
+def _encode_page_cursor(ref):
+    key = json.dumps([ref['category'], ref['subcategory'], ref['id']])
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+def _decode_page_cursor(cursor):
+    try:
+        category, subcategory, ref_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid page cursor: {cursor!r}") from None
+    if not (isinstance(category, str) and isinstance(subcategory, str) and isinstance(ref_id, int)):
+        raise ValueError(f"Invalid page cursor: {cursor!r}")
+    return [category, subcategory, ref_id]
+
+def get_references_page(include_private=False, category=None, subcategory=None, after=None,
+                        limit=REFERENCES_PAGE_SIZE):
+    """
+    Return (references, next_cursor) for one page of references ordered by
+    category, subcategory and id, optionally filtered. Pages are keyset
+    based: pass the returned next_cursor as `after` to get the following
+    page; it is None on the last page. Raises ValueError for a bad cursor.
+    """
+    clauses, params = _reference_filters(include_private, category, subcategory)
+    if after:
+        clauses.append('(category, subcategory, id) > (?, ?, ?)')
+        params.extend(_decode_page_cursor(after))
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
 
-        if subcategory not in organized_refs[category]:
-            organized_refs[category][subcategory] = []
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT * FROM [references] {where}
+        ORDER BY category, subcategory, id
+        LIMIT ?
+    ''', params + [limit + 1])
+    references = [Record(row, REFERENCE_DATE_FIELDS) for row in cursor.fetchall()]
+
+    # The extra row only tells whether another page exists
+    if len(references) > limit:
+        references = references[:limit]
+        return references, _encode_page_cursor(references[-1])
+    return references, None
+
+def get_reference_ids(include_private=False, category=None, subcategory=None):
+    clauses, params = _reference_filters(include_private, category, subcategory)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
 
-        organized_refs[category][subcategory].append(convert_date_fields(ref, ['upload_date']))
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT id FROM [references] {where} ORDER BY category, subcategory, id', params)
+    return [row['id'] for row in cursor.fetchall()]
 
-    conn.close()
-    return organized_refs
+def get_reference_facets(include_private=False):
+    """
+    Return {category: [subcategory, ...]} for the visible references.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    clauses, params = _reference_filters(include_private, None, None)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    cursor.execute(f'''
+        SELECT DISTINCT category, subcategory FROM [references] {where}
+        ORDER BY category, subcategory
+    ''', params)
+
+    facets = {}
+    for row in cursor.fetchall():
+        facets.setdefault(row['category'], []).append(row['subcategory'])
+    return facets
 
 def get_public_references():
     return get_organized_references(include_private=False)
@@ -248,8 +808,7 @@ def get_all_references():
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM [references] ORDER BY category, subcategory')
-    references = [convert_date_fields(row, ['upload_date']) for row in cursor.fetchall()]
-    conn.close()
+    references = [Record(row, REFERENCE_DATE_FIELDS) for row in cursor.fetchall()]
     return references
 
 def get_reference_categories():
@@ -257,7 +816,6 @@ def get_reference_categories():
     cursor = conn.cursor()
     cursor.execute('SELECT DISTINCT category FROM [references] ORDER BY category')
     categories = [row['category'] for row in cursor.fetchall()]
-    conn.close()
     return categories
 
 def get_reference_folders():
@@ -265,7 +823,6 @@ def get_reference_folders():
     cursor = conn.cursor()
     cursor.execute('SELECT DISTINCT subcategory FROM [references] ORDER BY subcategory')
     folders = [row['subcategory'] for row in cursor.fetchall()]
-    conn.close()
     return folders
 
 def get_reference_by_id(ref_id):
@@ -273,21 +830,43 @@ def get_reference_by_id(ref_id):
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM [references] WHERE id = ?', (ref_id,))
     reference = cursor.fetchone()
-    conn.close()
     if reference:
-        return convert_date_fields(reference, ['upload_date'])
+        return Record(reference, REFERENCE_DATE_FIELDS)
     return None
 
-def add_reference(filename, name, category, subcategory, description, public, watermarked):
+def get_references_by_ids(ref_ids):
+    """
+    Fetch many references at once, in the order of ref_ids. Unknown ids
+    are skipped and duplicates are returned once.
+    """
+    ref_ids = list(dict.fromkeys(int(ref_id) for ref_id in ref_ids))
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    references = {}
+    for start in range(0, len(ref_ids), ID_CHUNK_SIZE):
+        chunk = ref_ids[start:start + ID_CHUNK_SIZE]
+        placeholders = ', '.join('?' * len(chunk))
+        cursor.execute(f'SELECT * FROM [references] WHERE id IN ({placeholders})', chunk)
+        for row in cursor.fetchall():
+            references[row['id']] = Record(row, REFERENCE_DATE_FIELDS)
+
+    return [references[ref_id] for ref_id in ref_ids if ref_id in references]
+
+def add_reference(filename, name, category, subcategory, description, public, watermarked,
+                  original_filename=None, watermark_text=None, watermark_opacity=None, watermark_angle=None,
+                  processing=0):
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('''
-        INSERT INTO [references] (filename, name, category, subcategory, description, public, watermarked)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (filename, name, category, subcategory, description, public, watermarked))
+        INSERT INTO [references] (filename, name, category, subcategory, description, public, watermarked,
+                                  original_filename, watermark_text, watermark_opacity, watermark_angle,
+                                  processing)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (filename, name, category, subcategory, description, public, watermarked,
+          original_filename, watermark_text, watermark_opacity, watermark_angle, processing))
     ref_id = cursor.lastrowid
     conn.commit()
-    conn.close()
     return ref_id
 
 def update_reference(ref_id, name, category, subcategory, description, public):
@@ -299,7 +878,19 @@ def update_reference(ref_id, name, category, subcategory, description, public):
         WHERE id = ?
     ''', (name, category, subcategory, description, public, ref_id))
     conn.commit()
-    conn.close()
+    return True
+
+def update_reference_watermark(ref_id, filename, original_filename, watermarked,
+                               watermark_text, watermark_opacity, watermark_angle):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE [references]
+        SET filename = ?, original_filename = ?, watermarked = ?,
+            watermark_text = ?, watermark_opacity = ?, watermark_angle = ?
+        WHERE id = ?
+    ''', (filename, original_filename, watermarked, watermark_text, watermark_opacity, watermark_angle, ref_id))
+    conn.commit()
     return True
 
 def delete_reference(ref_id):
@@ -311,40 +902,42 @@ def delete_reference(ref_id):
     if result:
         cursor.execute('DELETE FROM [references] WHERE id = ?', (ref_id,))
         conn.commit()
-        conn.close()
         return result['filename']
 
-    conn.close()
     return None
 
 # Custom reference related functions
 def get_custom_references():
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM [custom_references] ORDER BY creation_date DESC')
-    custom_refs = cursor.fetchall()
 
-    # Get count of references for each custom reference
-    for i, ref in enumerate(custom_refs):
-        cursor.execute('''
-            SELECT COUNT(*) as count FROM [custom_reference_items]
-            WHERE custom_ref_id = ?
-        ''', (ref['id'],))
-        count = cursor.fetchone()['count']
-        custom_refs[i] = convert_date_fields(ref, ['creation_date'])
-        custom_refs[i]['ref_count'] = count
+    # Count the references of every custom reference in one grouped query
+    cursor.execute('''
+        SELECT cr.*, COUNT(cri.id) as ref_count
+        FROM [custom_references] cr
+        LEFT JOIN [custom_reference_items] cri ON cri.custom_ref_id = cr.id
+        GROUP BY cr.id
+        ORDER BY cr.creation_date DESC
+    ''')
 
-    conn.close()
-    return custom_refs
+    return [Record(row, CUSTOM_REFERENCE_DATE_FIELDS) for row in cursor.fetchall()]
+
+def get_custom_reference_choices():
+    """
+    Lightweight listing (id, name, link_id) for select dropdowns.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, name, link_id FROM [custom_references] ORDER BY creation_date DESC')
+    return [dict(row) for row in cursor.fetchall()]
 
 def get_custom_reference_by_link_id(link_id):
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM [custom_references] WHERE link_id = ?', (link_id,))
     custom_ref = cursor.fetchone()
-    conn.close()
     if custom_ref:
-        return convert_date_fields(custom_ref, ['creation_date'])
+        return Record(custom_ref, CUSTOM_REFERENCE_DATE_FIELDS)
     return None
 
 def get_custom_reference_by_id(custom_ref_id):
@@ -352,9 +945,8 @@ def get_custom_reference_by_id(custom_ref_id):
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM [custom_references] WHERE id = ?', (custom_ref_id,))
     custom_ref = cursor.fetchone()
-    conn.close()
     if custom_ref:
-        return convert_date_fields(custom_ref, ['creation_date'])
+        return Record(custom_ref, CUSTOM_REFERENCE_DATE_FIELDS)
     return None
 
 def get_references_for_custom_ref(custom_ref_id):
@@ -365,8 +957,7 @@ def get_references_for_custom_ref(custom_ref_id):
         JOIN custom_reference_items cri ON r.id = cri.reference_id
         WHERE cri.custom_ref_id = ?
     ''', (custom_ref_id,))
-    references = [convert_date_fields(row, ['upload_date']) for row in cursor.fetchall()]
-    conn.close()
+    references = [Record(row, REFERENCE_DATE_FIELDS) for row in cursor.fetchall()]
     return references
 
 def create_custom_reference(name, link_id, reference_ids):
@@ -381,14 +972,12 @@ def create_custom_reference(name, link_id, reference_ids):
     custom_ref_id = cursor.lastrowid
 
     # Add selected references
-    for ref_id in reference_ids:
-        cursor.execute('''
-            INSERT INTO [custom_reference_items] (custom_ref_id, reference_id)
-            VALUES (?, ?)
-        ''', (custom_ref_id, ref_id))
+    cursor.executemany('''
+        INSERT OR IGNORE INTO [custom_reference_items] (custom_ref_id, reference_id)
+        VALUES (?, ?)
+    ''', [(custom_ref_id, ref_id) for ref_id in set(reference_ids)])
 
     conn.commit()
-    conn.close()
     return custom_ref_id
 
 def update_custom_reference(custom_ref_id, name, reference_ids):
@@ -402,26 +991,34 @@ def update_custom_reference(custom_ref_id, name, reference_ids):
         WHERE id = ?
     ''', (name, custom_ref_id))
 
-    # Delete all existing reference items
-    cursor.execute('DELETE FROM [custom_reference_items] WHERE custom_ref_id = ?', (custom_ref_id,))
-
-    # Add new selected references
-    for ref_id in reference_ids:
-        cursor.execute('''
-            INSERT INTO [custom_reference_items] (custom_ref_id, reference_id)
-            VALUES (?, ?)
-        ''', (custom_ref_id, ref_id))
+    # Only touch the memberships that actually changed
+    cursor.execute('''
+        SELECT reference_id FROM [custom_reference_items]
+        WHERE custom_ref_id = ?
+    ''', (custom_ref_id,))
+    current_ids = {row['reference_id'] for row in cursor.fetchall()}
+    selected_ids = set(reference_ids)
+
+    cursor.executemany('''
+        DELETE FROM [custom_reference_items]
+        WHERE custom_ref_id = ? AND reference_id = ?
+    ''', [(custom_ref_id, ref_id) for ref_id in current_ids - selected_ids])
+    cursor.executemany('''
+        INSERT OR IGNORE INTO [custom_reference_items] (custom_ref_id, reference_id)
+        VALUES (?, ?)
+    ''', [(custom_ref_id, ref_id) for ref_id in selected_ids - current_ids])
 
     conn.commit()
-    conn.close()
     return True
 
 def delete_custom_reference(custom_ref_id):
     conn = get_db_connection()
     cursor = conn.cursor()
+    # Commissions made from it are kept, without the link
+    cursor.execute('UPDATE [commissions] SET custom_ref_id = NULL WHERE custom_ref_id = ?', (custom_ref_id,))
+    # Its items are deleted by the cascade
     cursor.execute('DELETE FROM [custom_references] WHERE id = ?', (custom_ref_id,))
     conn.commit()
-    conn.close()
     return True
 
 def get_selected_references_for_custom_ref(custom_ref_id):
@@ -432,7 +1029,6 @@ def get_selected_references_for_custom_ref(custom_ref_id):
         WHERE custom_ref_id = ?
     ''', (custom_ref_id,))
     selected_refs = [row['reference_id'] for row in cursor.fetchall()]
-    conn.close()
     return selected_refs
 
 # Artist related functions
@@ -441,7 +1037,6 @@ def get_all_artists():
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM [artists] ORDER BY name')
     artists = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     return artists
 
 def get_artist_by_id(artist_id):
@@ -449,7 +1044,6 @@ def get_artist_by_id(artist_id):
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM [artists] WHERE id = ?', (artist_id,))
     artist = cursor.fetchone()
-    conn.close()
     return dict(artist) if artist else None
 
 def add_artist(name, social_links, notes):
@@ -461,7 +1055,6 @@ def add_artist(name, social_links, notes):
     ''', (name, social_links, notes))
     artist_id = cursor.lastrowid
     conn.commit()
-    conn.close()
     return artist_id
 
 def update_artist(artist_id, name, social_links, notes):
@@ -473,7 +1066,6 @@ def update_artist(artist_id, name, social_links, notes):
         WHERE id = ?
     ''', (name, social_links, notes, artist_id))
     conn.commit()
-    conn.close()
     return True
 
 def delete_artist(artist_id):
@@ -485,70 +1077,42 @@ def delete_artist(artist_id):
     commission_count = cursor.fetchone()[0]
 
     if commission_count > 0:
-        conn.close()
         return False
 
     # Delete artist
     cursor.execute('DELETE FROM [artists] WHERE id = ?', (artist_id,))
     conn.commit()
-    conn.close()
     return True
 
 # Commission related functions
-def get_public_commissions():
+def _get_commissions(public_only):
     conn = get_db_connection()
     cursor = conn.cursor()
 
-    # Get all public commissions with artist info
-    cursor.execute('''
-        SELECT c.*, a.name as artist_name 
+    # Commissions with artist name, first image and image count in one pass
+    cursor.execute(f'''
+        SELECT c.*, a.name as artist_name,
+               ci.id as thumbnail_id, ci.filename as thumbnail, ci.processing as thumbnail_processing,
+               COALESCE(ci.image_count, 0) as image_count
         FROM [commissions] c
         JOIN [artists] a ON c.artist_id = a.id
-        WHERE c.public = 1
+        LEFT JOIN (
+            SELECT id, commission_id, filename, processing,
+                   ROW_NUMBER() OVER (PARTITION BY commission_id ORDER BY display_order, id) as position,
+                   COUNT(*) OVER (PARTITION BY commission_id) as image_count
+            FROM [commission_images]
+        ) ci ON ci.commission_id = c.id AND ci.position = 1
+        {'WHERE c.public = 1' if public_only else ''}
         ORDER BY c.commission_date DESC
     ''')
-    commissions = cursor.fetchall()
 
-    # Get the first image for each commission for the thumbnail
-    for i, comm in enumerate(commissions):
-        cursor.execute('''
-            SELECT filename FROM [commission_images] 
-            WHERE commission_id = ? 
-            ORDER BY display_order LIMIT 1
-        ''', (comm['id'],))
-        thumbnail = cursor.fetchone()
-        commissions[i] = convert_date_fields(comm, ['commission_date'])
-        commissions[i]['thumbnail'] = thumbnail['filename'] if thumbnail else None
+    return [Record(row, COMMISSION_DATE_FIELDS) for row in cursor.fetchall()]
 
-    conn.close()
-    return commissions
+def get_public_commissions():
+    return _get_commissions(public_only=True)
 
 def get_all_commissions():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Get all commissions with artist info
-    cursor.execute('''
-        SELECT c.*, a.name as artist_name 
-        FROM [commissions] c
-        JOIN [artists] a ON c.artist_id = a.id
-        ORDER BY c.commission_date DESC
-    ''')
-    commissions = cursor.fetchall()
-
-    # Get the first image for each commission for the thumbnail
-    for i, comm in enumerate(commissions):
-        cursor.execute('''
-            SELECT filename FROM [commission_images] 
-            WHERE commission_id = ? 
-            ORDER BY display_order LIMIT 1
-        ''', (comm['id'],))
-        thumbnail = cursor.fetchone()
-        commissions[i] = convert_date_fields(comm, ['commission_date'])
-        commissions[i]['thumbnail'] = thumbnail['filename'] if thumbnail else None
-
-    conn.close()
-    return commissions
+    return _get_commissions(public_only=False)
 
 def get_commission_by_id(commission_id, public_only=True):
     conn = get_db_connection()
@@ -575,7 +1139,6 @@ def get_commission_by_id(commission_id, public_only=True):
     commission = cursor.fetchone()
 
     if not commission:
-        conn.close()
         return None
 
     # Get all images for this commission
@@ -586,10 +1149,9 @@ def get_commission_by_id(commission_id, public_only=True):
     ''', (commission_id,))
     images = [dict(row) for row in cursor.fetchall()]
 
-    result = convert_date_fields(commission, ['commission_date'])
+    result = Record(commission, COMMISSION_DATE_FIELDS)
     result['images'] = images
 
-    conn.close()
     return result
 
 def add_commission(title, artist_id, description, price, commission_date, commission_link, custom_ref_id, public):
@@ -605,7 +1167,6 @@ def add_commission(title, artist_id, description, price, commission_date, commis
     commission_id = cursor.lastrowid
 
     conn.commit()
-    conn.close()
     return commission_id
 
 def update_commission(commission_id, title, artist_id, description, price, commission_date, commission_link, custom_ref_id, public):
@@ -621,7 +1182,6 @@ def update_commission(commission_id, title, artist_id, description, price, commi
          commission_link, custom_ref_id, public, commission_id))
 
     conn.commit()
-    conn.close()
     return True
 
 def delete_commission(commission_id):
@@ -632,67 +1192,503 @@ def delete_commission(commission_id):
     cursor.execute('SELECT filename FROM [commission_images] WHERE commission_id = ?', (commission_id,))
     images = cursor.fetchall()
 
-    # Delete commission (cascade will delete images)
+    # Delete commission (cascade will delete images, and their trigger
+    # the rows of their responsive copies)
     cursor.execute('DELETE FROM [commissions] WHERE id = ?', (commission_id,))
 
     conn.commit()
-    conn.close()
 
     return [row['filename'] for row in images]
 
-def add_commission_image(commission_id, filename, display_order):
+def add_commission_image(commission_id, filename, display_order, original_filename=None, watermarked=0,
+                         watermark_text=None, watermark_opacity=None, watermark_angle=None, processing=0):
     conn = get_db_connection()
     cursor = conn.cursor()
 
     cursor.execute('''
-        INSERT INTO [commission_images] (commission_id, filename, display_order)
-        VALUES (?, ?, ?)
-    ''', (commission_id, filename, display_order))
+        INSERT INTO [commission_images] (commission_id, filename, display_order, original_filename, watermarked,
+                                         watermark_text, watermark_opacity, watermark_angle, processing)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (commission_id, filename, display_order, original_filename, watermarked,
+          watermark_text, watermark_opacity, watermark_angle, processing))
 
     image_id = cursor.lastrowid
     conn.commit()
-    conn.close()
     return image_id
 
+def add_commission_images(commission_id, images):
+    """
+    Insert several commission images in one transaction. images are dicts
+    with display_order and the other add_commission_image arguments.
+    Returns the new ids, in the order of images.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        image_ids = []
+        for image in images:
+            cursor.execute('''
+                INSERT INTO [commission_images] (commission_id, filename, display_order, original_filename,
+                                                 watermarked, watermark_text, watermark_opacity, watermark_angle,
+                                                 processing)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (commission_id, image['filename'], image['display_order'], image.get('original_filename'),
+                  image.get('watermarked', 0), image.get('watermark_text'), image.get('watermark_opacity'),
+                  image.get('watermark_angle'), image.get('processing', 0)))
+            image_ids.append(cursor.lastrowid)
+        conn.commit()
+        return image_ids
+    except Exception:
+        conn.rollback()
+        raise
+
+def update_commission_image_watermarks(images):
+    """
+    Point commission images at new watermarked copies. images are dicts
+    with id, filename, watermarked and the three watermark settings.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    try:
+        cursor.executemany('''
+            UPDATE [commission_images]
+            SET filename = ?, watermarked = ?, watermark_text = ?, watermark_opacity = ?, watermark_angle = ?
+            WHERE id = ?
+        ''', [(image['filename'], image['watermarked'], image['watermark_text'],
+               image['watermark_opacity'], image['watermark_angle'], image['id']) for image in images])
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f"Error updating image watermarks: {e}")
+        conn.rollback()
+        return False
+
 def delete_commission_image(image_id):
     conn = get_db_connection()
     cursor = conn.cursor()
 
     # Get image details
-    cursor.execute('SELECT commission_id, filename FROM [commission_images] WHERE id = ?', (image_id,))
+    cursor.execute('''
+        SELECT commission_id, filename, original_filename FROM [commission_images] WHERE id = ?
+    ''', (image_id,))
     result = cursor.fetchone()
 
     if result:
         # Delete from database
         cursor.execute('DELETE FROM [commission_images] WHERE id = ?', (image_id,))
         conn.commit()
-        conn.close()
         return dict(result)
 
-    conn.close()
     return None
 
-def update_commission_image_order(image_orders):
+def get_commission_image(image_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    # Image with its commission's visibility
+    cursor.execute('''
+        SELECT ci.*, c.public FROM [commission_images] ci
+        JOIN [commissions] c ON ci.commission_id = c.id
+        WHERE ci.id = ?
+    ''', (image_id,))
+    image = cursor.fetchone()
+    if image:
+        return Record(image)
+    return None
+
+def get_watermarked_commission_images():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    # Images still being processed get their watermark from their own job
+    cursor.execute('''
+        SELECT * FROM [commission_images]
+        WHERE watermarked = 1 AND processing = 0
+        ORDER BY commission_id, display_order
+    ''')
+    return [Record(row) for row in cursor.fetchall()]
+
+def update_commission_image_order(commission_id, ordered_image_ids):
+    """
+    Set the display order of a commission's images to the order of
+    ordered_image_ids. Fails without changes if any id belongs to another
+    commission; rows whose order is unchanged are not written.
+    """
     conn = get_db_connection()
     cursor = conn.cursor()
 
     try:
-        for image_id, display_order in image_orders:
-            cursor.execute('''
-                UPDATE [commission_images] 
-                SET display_order = ?
-                WHERE id = ?
-            ''', (display_order, image_id))
+        cursor.execute('''
+            SELECT id, display_order FROM [commission_images]
+            WHERE commission_id = ?
+        ''', (commission_id,))
+        current_orders = {row['id']: row['display_order'] for row in cursor.fetchall()}
+
+        unknown_ids = set(ordered_image_ids) - current_orders.keys()
+        if unknown_ids:
+            print(f"Error updating image order: images {sorted(unknown_ids)} "
+                  f"do not belong to commission {commission_id}")
+            return False
+
+        changes = [(display_order, image_id, commission_id)
+                   for display_order, image_id in enumerate(ordered_image_ids)
+                   if current_orders[image_id] != display_order]
+        cursor.executemany('''
+            UPDATE [commission_images] 
+            SET display_order = ?
+            WHERE id = ? AND commission_id = ?
+        ''', changes)
 
         conn.commit()
-        conn.close()
         return True
     except Exception as e:
         print(f"Error updating image order: {e}")
         conn.rollback()
-        conn.close()
         return False
 
+# Image derivative related functions
+def add_image_derivatives(kind, owner_id, derivatives):
+    """
+    Record the responsive copies of an image, given as dicts with width,
+    height, format and path (relative to static/). Replaces existing
+    copies of the same format and width.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    try:
+        cursor.executemany('''
+            INSERT OR REPLACE INTO [image_derivatives] (kind, owner_id, width, height, format, path)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(kind, owner_id, d['width'], d['height'], d['format'], d['path']) for d in derivatives])
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f"Error adding image derivatives: {e}")
+        conn.rollback()
+        return False
+
+def delete_image_derivatives(kind, owner_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM [image_derivatives] WHERE kind = ? AND owner_id = ?', (kind, owner_id))
+    conn.commit()
+    return True
+
+def get_image_derivatives(kind, owner_ids):
+    """
+    Responsive copies of many images at once, as {owner_id: [derivative]}
+    with each list ordered by format and width.
+    """
+    owner_ids = list(dict.fromkeys(int(owner_id) for owner_id in owner_ids))
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    derivatives = {}
+    for start in range(0, len(owner_ids), ID_CHUNK_SIZE):
+        chunk = owner_ids[start:start + ID_CHUNK_SIZE]
+        placeholders = ', '.join('?' * len(chunk))
+        cursor.execute(f'''
+            SELECT owner_id, width, height, format, path FROM [image_derivatives]
+            WHERE kind = ? AND owner_id IN ({placeholders})
+            ORDER BY owner_id, format, width
+        ''', [kind, *chunk])
+        for row in cursor.fetchall():
+            derivatives.setdefault(row['owner_id'], []).append(Record(row))
+
+    return derivatives
+
+# Job related functions
+JOB_DATE_FIELDS = ('run_after', 'locked_at', 'created_at', 'updated_at')
+
+def enqueue_job(kind, payload, max_attempts=JOB_MAX_ATTEMPTS, unique=False):
+    """
+    Queue a job and return its id. With unique, a job of the same kind and
+    payload still waiting in the queue is reused instead.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    payload = json.dumps(payload)
+
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        if unique:
+            cursor.execute('''
+                SELECT id FROM [jobs] WHERE status = 'queued' AND kind = ? AND payload = ?
+            ''', (kind, payload))
+            existing = cursor.fetchone()
+            if existing:
+                conn.commit()
+                return existing['id']
+        cursor.execute('''
+            INSERT INTO [jobs] (kind, payload, max_attempts)
+            VALUES (?, ?, ?)
+        ''', (kind, payload, max_attempts))
+        job_id = cursor.lastrowid
+        conn.commit()
+        return job_id
+    except Exception:
+        conn.rollback()
+        raise
+
+def claim_job(worker_id, lease_seconds=JOB_LEASE_SECONDS):
+    """
+    Mark the oldest runnable job as running for worker_id and return it,
+    or None. Jobs left running past their lease by a worker that died are
+    claimed again.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    # Take the write lock first so two workers can't claim the same job
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        cursor.execute('''
+            SELECT * FROM [jobs]
+            WHERE (status = 'queued' AND run_after <= datetime('now'))
+               OR (status = 'running' AND locked_at <= datetime('now', ?) AND attempts < max_attempts)
+            ORDER BY id
+            LIMIT 1
+        ''', (f'-{lease_seconds} seconds',))
+        job = cursor.fetchone()
+        if not job:
+            conn.commit()
+            return None
+
+        cursor.execute('''
+            UPDATE [jobs]
+            SET status = 'running', attempts = attempts + 1, locked_by = ?,
+                locked_at = datetime('now'), updated_at = datetime('now')
+            WHERE id = ?
+        ''', (worker_id, job['id']))
+        cursor.execute('SELECT * FROM [jobs] WHERE id = ?', (job['id'],))
+        job = Record(cursor.fetchone(), JOB_DATE_FIELDS)
+        conn.commit()
+        return job
+    except Exception:
+        conn.rollback()
+        raise
+
+def fail_abandoned_jobs(lease_seconds=JOB_LEASE_SECONDS):
+    """
+    Mark as failed the jobs whose every attempt ended with the worker dying,
+    and return them.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        cursor.execute('''
+            SELECT * FROM [jobs]
+            WHERE status = 'running' AND locked_at <= datetime('now', ?) AND attempts >= max_attempts
+        ''', (f'-{lease_seconds} seconds',))
+        abandoned = [Record(row, JOB_DATE_FIELDS) for row in cursor.fetchall()]
+        cursor.executemany('''
+            UPDATE [jobs]
+            SET status = 'failed', error = COALESCE(error, 'The worker stopped while running this job'),
+                locked_by = NULL, updated_at = datetime('now')
+            WHERE id = ?
+        ''', [(job['id'],) for job in abandoned])
+        conn.commit()
+        return abandoned
+    except Exception:
+        conn.rollback()
+        raise
+
+def update_job_progress(job_id, progress, details=None):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    # Also renews the job's lease
+    cursor.execute('''
+        UPDATE [jobs]
+        SET progress = ?, details = COALESCE(?, details), locked_at = datetime('now'), updated_at = datetime('now')
+        WHERE id = ?
+    ''', (progress, json.dumps(details) if details is not None else None, job_id))
+    conn.commit()
+    return True
+
+def complete_job(job_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE [jobs]
+        SET status = 'done', progress = 1, error = NULL, locked_by = NULL, updated_at = datetime('now')
+        WHERE id = ?
+    ''', (job_id,))
+    conn.commit()
+    return True
+
+def fail_job(job_id, error, retry_delay):
+    """
+    Record a failed attempt. The job is queued again after retry_delay
+    seconds, or marked failed once it has used all its attempts.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE [jobs]
+        SET status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+            run_after = datetime('now', ?), error = ?, locked_by = NULL, updated_at = datetime('now')
+        WHERE id = ?
+    ''', (f'+{int(retry_delay)} seconds', error, job_id))
+    conn.commit()
+    return True
+
+def retry_job(job_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE [jobs]
+        SET status = 'queued', attempts = 0, progress = 0, details = NULL, run_after = datetime('now'), updated_at = datetime('now')
+        WHERE id = ? AND status = 'failed'
+    ''', (job_id,))
+    conn.commit()
+    return cursor.rowcount > 0
+
+def get_job(job_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM [jobs] WHERE id = ?', (job_id,))
+    job = cursor.fetchone()
+    if job:
+        return Record(job, JOB_DATE_FIELDS)
+    return None
+
+def get_recent_jobs(limit=20):
+    """
+    Unfinished and failed jobs first, then the most recently finished ones.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT * FROM [jobs]
+        ORDER BY status = 'done', id DESC
+        LIMIT ?
+    ''', (limit,))
+    return [Record(row, JOB_DATE_FIELDS) for row in cursor.fetchall()]
+
+def set_reference_processing(ref_id, processing):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('UPDATE [references] SET processing = ? WHERE id = ?', (processing, ref_id))
+    conn.commit()
+    return True
+
+def set_commission_images_processing(image_ids, processing):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany('''
+        UPDATE [commission_images] SET processing = ? WHERE id = ?
+    ''', [(processing, image_id) for image_id in image_ids])
+    conn.commit()
+    return True
+
+# Download token related functions
+def create_download_token(reference_ids, custom_ref_name=None, ttl=DOWNLOAD_TOKEN_TTL):
+    """
+    Store a reference selection for a later zip download and return its
+    token. The same selection gets the same token back while it is valid,
+    with its expiry extended.
+    """
+    reference_ids = [int(ref_id) for ref_id in reference_ids]
+    selection = json.dumps([reference_ids, custom_ref_name])
+    selection_key = hashlib.sha256(selection.encode()).hexdigest()
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM [download_tokens] WHERE expires_at <= datetime('now')")
+
+    cursor.execute('''
+        SELECT token FROM [download_tokens]
+        WHERE selection_key = ?
+    ''', (selection_key,))
+    existing = cursor.fetchone()
+    if existing:
+        token = existing['token']
+        cursor.execute('''
+            UPDATE [download_tokens]
+            SET expires_at = datetime('now', ?)
+            WHERE token = ?
+        ''', (f'+{ttl} seconds', token))
+    else:
+        token = secrets.token_urlsafe(16)
+        cursor.execute('''
+            INSERT INTO [download_tokens] (token, selection_key, reference_ids, custom_ref_name, expires_at)
+            VALUES (?, ?, ?, ?, datetime('now', ?))
+        ''', (token, selection_key, json.dumps(reference_ids), custom_ref_name, f'+{ttl} seconds'))
+
+    conn.commit()
+    return token
+
+def get_download_token(token):
+    """
+    Return the unexpired selection stored under token as a dict with
+    'reference_ids', 'custom_ref_name' and 'selection_key', or None.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT * FROM [download_tokens]
+        WHERE token = ? AND expires_at > datetime('now')
+    ''', (token,))
+    result = cursor.fetchone()
+    if not result:
+        return None
+    return {
+        'reference_ids': json.loads(result['reference_ids']),
+        'custom_ref_name': result['custom_ref_name'],
+        'selection_key': result['selection_key']
+    }
+
+# Search related functions
+def _build_match_query(query):
+    # Quote every term so user input can't inject FTS5 syntax, and match
+    # each one as a prefix for search-as-you-type
+    terms = re.findall(r'\w+', query)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+def search(query, include_private=False, page=1, per_page=SEARCH_PAGE_SIZE):
+    """
+    Ranked full-text search over references, commissions and artists.
+    Returns (results, has_more). Without include_private only public
+    references and commissions are returned, and artists are left out.
+    """
+    match_query = _build_match_query(query)
+    if not match_query:
+        return [], False
+
+    visibility = '' if include_private else f'''
+        AND ((s.rowid % 4 = {SEARCH_KIND_REFERENCE} AND r.public = 1 AND r.processing = 0)
+             OR (s.rowid % 4 = {SEARCH_KIND_COMMISSION} AND c.public = 1))
+    '''
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    # Title matches weigh more than tags, which weigh more than descriptions
+    cursor.execute(f'''
+        SELECT s.rowid % 4 as kind, s.rowid / 4 as item_id,
+               r.filename, r.name, r.category, r.subcategory,
+               c.title, a.name as artist_name
+        FROM [search_index] s
+        LEFT JOIN [references] r ON s.rowid % 4 = {SEARCH_KIND_REFERENCE} AND r.id = s.rowid / 4
+        LEFT JOIN [commissions] c ON s.rowid % 4 = {SEARCH_KIND_COMMISSION} AND c.id = s.rowid / 4
+        LEFT JOIN [artists] a ON s.rowid % 4 = {SEARCH_KIND_ARTIST} AND a.id = s.rowid / 4
+        WHERE [search_index] MATCH ? {visibility}
+        ORDER BY bm25([search_index], 10.0, 1.0, 3.0)
+        LIMIT ? OFFSET ?
+    ''', (match_query, per_page + 1, (max(page, 1) - 1) * per_page))
+    rows = cursor.fetchall()
+
+    results = []
+    for row in rows[:per_page]:
+        result = Record(row)
+        result['kind'] = SEARCH_KINDS[row['kind']]
+        results.append(result)
+    return results, len(rows) > per_page
+
 # Dashboard related functions
 def rename_category(old_category, new_category):
     """
@@ -707,7 +1703,6 @@ def rename_category(old_category, new_category):
     ''', (new_category, old_category))
     affected_rows = cursor.rowcount
     conn.commit()
-    conn.close()
     return affected_rows
 
 def rename_subcategory(old_subcategory, new_subcategory, category=None):
@@ -733,7 +1728,6 @@ def rename_subcategory(old_subcategory, new_subcategory, category=None):
 
     affected_rows = cursor.rowcount
     conn.commit()
-    conn.close()
     return affected_rows
 
 def get_dashboard_counts():
@@ -752,8 +1746,6 @@ def get_dashboard_counts():
     cursor.execute('SELECT COUNT(*) as custom_ref_count FROM [custom_references]')
     custom_ref_count = cursor.fetchone()['custom_ref_count']
 
-    conn.close()
-
     return {
         'ref_count': ref_count,
         'comm_count': comm_count,
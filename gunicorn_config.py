@@ -1,4 +1,7 @@
 # Gunicorn configuration file
+import subprocess
+import sys
+
 from app import app
 
 # Bind to port 8000
@@ -7,8 +10,12 @@ bind = "127.0.0.1:8000"
 # Number of worker processes
 workers = 3
 
-# Worker class to use
-worker_class = "sync"
+# Worker class to use. Threaded workers keep sending heartbeats while a
+# thread streams a long download, so large zips aren't killed at `timeout`.
+worker_class = "gthread"
+
+# Threads per worker process
+threads = 4
 
 # Timeout for worker processes (in seconds)
 timeout = 120
@@ -25,4 +32,19 @@ preload_app = True
 
 # Reload workers when code changes (for development)
 # Set to False in production
-reload = False
\ No newline at end of file
+reload = False
+# Background job worker (worker.py), started and stopped with the server so
+# image processing never runs inside a web worker
+job_worker = None
+
+def on_starting(server):
+    global job_worker
+    job_worker = subprocess.Popen([sys.executable, 'worker.py'])
+
+def on_exit(server):
+    if job_worker is not None:
+        job_worker.terminate()
+        try:
+            job_worker.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            job_worker.kill()
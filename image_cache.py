@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from functools import lru_cache
+
+from PIL import Image
+
+from utils import DERIVATIVE_FORMATS, DERIVATIVE_SAVE_OPTIONS, DERIVATIVE_WIDTHS, save_resized
+
+# Images resized on request, named after a hash of their source and size
+IMAGE_CACHE_DIR = os.path.join('cache', 'images')
+# Least recently used images are evicted past this total size, 1 GiB unless
+# IMAGE_CACHE_MAX_BYTES is set
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 1024 ** 3))
+# Seconds between eviction passes of a worker
+IMAGE_CACHE_EVICT_INTERVAL = 60
+
+# Widths that can be requested; others are snapped up to the next one
+IMAGE_WIDTHS = DERIVATIVE_WIDTHS
+IMAGE_FORMATS = DERIVATIVE_FORMATS
+IMAGE_MIMETYPES = {'webp': 'image/webp', 'avif': 'image/avif'}
+
+# How long a request waits for another worker's render
+RENDER_TIMEOUT = 60
+# Age after which a render lock is considered abandoned by a worker that
+# died. Well above any render, so a slow one is never started twice.
+RENDER_LOCK_STALE_AFTER = 600
+
+# Widths of source images remembered, by file version
+SOURCE_WIDTH_CACHE_SIZE = 4096
+# EXIF orientation tag; values 5 to 8 turn the image a quarter turn
+ORIENTATION_TAG = 0x0112
+
+# Renders in progress in this process, by key
+_rendering = {}
+_rendering_lock = threading.Lock()
+_last_eviction = 0
+
+def snap_width(width):
+    """
+    The smallest allowed width that is at least width, or the largest one.
+    """
+    for allowed in IMAGE_WIDTHS:
+        if allowed >= width:
+            return allowed
+    return IMAGE_WIDTHS[-1]
+
+@lru_cache(maxsize=SOURCE_WIDTH_CACHE_SIZE)
+def _read_width(source_path, mtime_ns, size):
+    # Only the header is read
+    with Image.open(source_path) as img:
+        width, height = img.size
+        if img.getexif().get(ORIENTATION_TAG, 1) > 4:
+            width = height
+    return width
+
+def source_width(source_path):
+    """
+    Width of source_path as shown, after its EXIF orientation, or None if
+    it can't be read.
+    """
+    try:
+        stat = os.stat(source_path)
+        return _read_width(source_path, stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+
+def srcset_widths(source_path):
+    """
+    (width, requested width) of each srcset candidate for source_path: the
+    allowed widths below the source's, then the source's own width, which
+    is requested at the next allowed width as images are never enlarged.
+    All allowed widths if the source can't be read.
+    """
+    width = source_width(source_path)
+    if width is None or width > IMAGE_WIDTHS[-1]:
+        return [(allowed, allowed) for allowed in IMAGE_WIDTHS]
+    candidates = [(allowed, allowed) for allowed in IMAGE_WIDTHS if allowed < width]
+    candidates.append((width, snap_width(width)))
+    return candidates
+
+def image_key(source_path, width, fmt):
+    """
+    Hash of the source file's version and of the requested rendering, so a
+    changed source never hits an outdated cache entry.
+    """
+    stat = os.stat(source_path)
+    digest = hashlib.sha256(json.dumps([
+        os.path.abspath(source_path), stat.st_size, stat.st_mtime_ns,
+        width, fmt, DERIVATIVE_SAVE_OPTIONS[fmt],
+    ]).encode())
+    return digest.hexdigest()
+
+def _cached_image_path(key, fmt):
+    return os.path.join(IMAGE_CACHE_DIR, f'{key}.{fmt}')
+
+def _touch(path):
+    try:
+        # Mark as recently used for LRU eviction
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def _acquire_render_lock(lock_path, path):
+    """
+    Take the cross-process lock for rendering path. Returns False without
+    the lock if another worker rendered it in the meantime.
+    """
+    deadline = time.monotonic() + RENDER_TIMEOUT
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            pass
+
+        if os.path.exists(path):
+            return False
+        try:
+            # A worker that died mid-render leaves its lock behind
+            if time.time() - os.stat(lock_path).st_mtime > RENDER_LOCK_STALE_AFTER:
+                os.remove(lock_path)
+                continue
+        except FileNotFoundError:
+            continue
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Timed out waiting for {path} to be rendered")
+        time.sleep(0.05)
+
+def _render(source_path, path, width, fmt):
+    lock_path = path + '.lock'
+    if not _acquire_render_lock(lock_path, path):
+        return
+
+    try:
+        # Rendered by another worker between our check and taking the lock
+        if os.path.exists(path):
+            return
+        # Render under a temporary name so readers never see a partial image
+        fd, tmp_path = tempfile.mkstemp(dir=IMAGE_CACHE_DIR, suffix='.tmp')
+        os.close(fd)
+        try:
+            save_resized(source_path, tmp_path, width, fmt)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    finally:
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+
+def get_resized_image(source_path, width, fmt='webp'):
+    """
+    Path of source_path resized to width in fmt, rendered on the first
+    request and read from the cache afterwards. Concurrent requests for
+    the same image wait for a single render.
+    """
+    key = image_key(source_path, width, fmt)
+    path = _cached_image_path(key, fmt)
+    if _touch(path):
+        return path
+
+    with _rendering_lock:
+        event = _rendering.get(key)
+        rendering = event is None
+        if rendering:
+            event = _rendering[key] = threading.Event()
+
+    if not rendering:
+        # Another thread of this worker is rendering it
+        event.wait(RENDER_TIMEOUT)
+        if not os.path.exists(path):
+            raise OSError(f"Rendering {path} failed")
+        return path
+
+    try:
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        _render(source_path, path, width, fmt)
+    finally:
+        with _rendering_lock:
+            del _rendering[key]
+        event.set()
+
+    _evict_periodically()
+    return path
+
+def _evict_periodically():
+    global _last_eviction
+    now = time.monotonic()
+    with _rendering_lock:
+        if now - _last_eviction < IMAGE_CACHE_EVICT_INTERVAL:
+            return
+        _last_eviction = now
+    evict_image_cache()
+
+def evict_image_cache(max_bytes=IMAGE_CACHE_MAX_BYTES):
+    """
+    Delete least recently used images until the cache fits in max_bytes.
+    """
+    try:
+        names = os.listdir(IMAGE_CACHE_DIR)
+    except FileNotFoundError:
+        return
+
+    cached = []
+    for name in names:
+        if os.path.splitext(name)[1][1:] not in IMAGE_MIMETYPES:
+            continue
+        path = os.path.join(IMAGE_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        cached.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in cached)
+    for _, size, path in sorted(cached):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -0,0 +1,118 @@
+import json
+import os
+import socket
+import threading
+import traceback
+
+import db
+
+# Seconds an idle worker waits before looking for new jobs
+JOB_POLL_INTERVAL = 1.0
+# Seconds before a failed job is retried, doubled after each attempt
+JOB_RETRY_DELAY = 30
+
+# Job kind -> handler(payload, report_progress)
+_handlers = {}
+# Job kind -> on_failure(payload)
+_failure_handlers = {}
+
+def job_handler(kind, on_failure=None):
+    """
+    Register the decorated function as the handler of jobs of this kind.
+    It is called with the job's payload and a report_progress(fraction,
+    details=None) function, and fails the attempt by raising. details is a
+    JSON-serializable dict shown along with the job's progress.
+    on_failure(payload) is called once a job has used all its attempts.
+    """
+    def register(handler):
+        _handlers[kind] = handler
+        if on_failure:
+            _failure_handlers[kind] = on_failure
+        return handler
+    return register
+
+def enqueue(kind, payload, unique=False):
+    """
+    Queue a job for the worker. Returns its id. With unique, an identical
+    job that hasn't started yet is reused.
+    """
+    if kind not in _handlers:
+        raise ValueError(f"Unknown job kind: {kind}")
+    return db.enqueue_job(kind, payload, unique=unique)
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+def give_up_job(job):
+    """
+    Run the failure handler of a job that won't be attempted again.
+    """
+    on_failure = _failure_handlers.get(job['kind'])
+    if not on_failure:
+        return
+    try:
+        on_failure(json.loads(job['payload']))
+    except Exception:
+        traceback.print_exc()
+
+def run_job(job):
+    """
+    Run a claimed job and record its outcome. Returns True if it succeeded.
+    """
+    def report_progress(fraction, details=None):
+        db.update_job_progress(job['id'], min(1.0, max(0.0, fraction)), details)
+
+    try:
+        handler = _handlers[job['kind']]
+        handler(json.loads(job['payload']), report_progress)
+    except Exception as e:
+        traceback.print_exc()
+        # Drop what the handler left uncommitted, so fail_job doesn't commit it
+        db.get_db_connection().rollback()
+        db.fail_job(job['id'], f"{type(e).__name__}: {e}",
+                    JOB_RETRY_DELAY * 2 ** (job['attempts'] - 1))
+        if job['attempts'] >= job['max_attempts']:
+            give_up_job(job)
+        return False
+
+    db.complete_job(job['id'])
+    return True
+
+def run_pending_jobs(worker=None):
+    """
+    Run queued jobs until none is left to run now. Returns how many ran.
+    """
+    worker = worker or worker_id()
+    for job in db.fail_abandoned_jobs():
+        give_up_job(job)
+    count = 0
+    while True:
+        job = db.claim_job(worker)
+        if not job:
+            return count
+        run_job(job)
+        count += 1
+
+def run_worker(stop_event=None, poll_interval=JOB_POLL_INTERVAL):
+    """
+    Run jobs as they are queued until stop_event is set.
+    """
+    stop_event = stop_event or threading.Event()
+    worker = worker_id()
+    print(f"Job worker {worker} started")
+    while not stop_event.is_set():
+        try:
+            run_pending_jobs(worker)
+        except Exception as e:
+            # e.g. the database was locked for longer than the busy timeout
+            print(f"Error running jobs: {e}")
+        stop_event.wait(poll_interval)
+
+def start_worker_thread(stop_event=None):
+    """
+    Run the worker in a daemon thread of this process, for the development
+    server.
+    """
+    thread = threading.Thread(target=run_worker, args=(stop_event,), daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,112 @@
+import io
+import os
+import time
+import zipfile
+
+import pytest
+
+import archives
+from archives import ArchiveEntry, archive_size, stream_zip
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+def _entries(tmp_path, sizes, compress=False):
+    entries = []
+    for i, size in enumerate(sizes):
+        path = _write(tmp_path / f'file{i}.bin', os.urandom(size))
+        entries.append(ArchiveEntry(path, f'dir/file{i}.bin', compress=compress))
+    return entries
+
+def _build(entries):
+    return b''.join(stream_zip(entries))
+
+def _check_round_trip(entries, data):
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == [entry.arcname for entry in entries]
+        for entry, info in zip(entries, zf.infolist()):
+            with open(entry.path, 'rb') as f:
+                assert zf.read(info) == f.read()
+            assert info.file_size == entry.size
+            if entry.compress:
+                assert info.compress_type == zipfile.ZIP_DEFLATED
+            else:
+                # Streaming readers reject stored entries with a data descriptor
+                assert info.compress_type == zipfile.ZIP_STORED
+                assert not info.flag_bits & 0x08
+
+def test_stored_round_trip(tmp_path):
+    entries = _entries(tmp_path, [0, 1, 1000, archives.CHUNK_SIZE + 1])
+    data = _build(entries)
+    _check_round_trip(entries, data)
+    assert archive_size(entries) == len(data)
+
+def test_deflated_round_trip(tmp_path):
+    path = _write(tmp_path / 'notes.txt', b'hello archive\n' * 10000)
+    entries = [ArchiveEntry(path, 'notes.txt'), *_entries(tmp_path, [500])]
+    assert entries[0].compress
+    data = _build(entries)
+    _check_round_trip(entries, data)
+    assert archive_size(entries) is None
+
+def test_stored_local_header_has_crc_and_sizes(tmp_path):
+    entry = _entries(tmp_path, [300])[0]
+    data = _build([entry])
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        info = zf.infolist()[0]
+    # Local header: signature, version, flags, method, time, date, crc, sizes
+    flags, method = int.from_bytes(data[6:8], 'little'), int.from_bytes(data[8:10], 'little')
+    crc = int.from_bytes(data[14:18], 'little')
+    compress_size = int.from_bytes(data[18:22], 'little')
+    file_size = int.from_bytes(data[22:26], 'little')
+    assert not flags & 0x08
+    assert method == 0
+    assert (crc, compress_size, file_size) == (info.CRC, 300, 300)
+
+@pytest.mark.parametrize('offset', [-1, 0, 1])
+def test_zip64_size_boundary(tmp_path, monkeypatch, offset):
+    # A lowered limit exercises the ZIP64 fields without multi-GiB files
+    monkeypatch.setattr(archives, 'ZIP64_LIMIT', 1000)
+    entries = _entries(tmp_path, [1000 + offset, 10])
+    data = _build(entries)
+    _check_round_trip(entries, data)
+    assert archive_size(entries) == len(data)
+
+def test_zip64_offset_boundary(tmp_path, monkeypatch):
+    # Later entries start past the limit, so their offsets need ZIP64 fields
+    monkeypatch.setattr(archives, 'ZIP64_LIMIT', 1000)
+    entries = _entries(tmp_path, [400, 400, 400, 400])
+    data = _build(entries)
+    _check_round_trip(entries, data)
+    assert archive_size(entries) == len(data)
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.infolist()[-1].header_offset > 1000
+
+def test_zip64_file_count(tmp_path, monkeypatch):
+    monkeypatch.setattr(archives, 'ZIP_FILECOUNT_LIMIT', 3)
+    entries = _entries(tmp_path, [10] * 5)
+    data = _build(entries)
+    _check_round_trip(entries, data)
+    assert archive_size(entries) == len(data)
+
+def test_changed_file_is_detected(tmp_path):
+    entry = _entries(tmp_path, [100])[0]
+    chunks = stream_zip([entry])
+    next(chunks)  # header, with the CRC of the current content
+    _write(entry.path, os.urandom(100))
+    with pytest.raises(OSError):
+        list(chunks)
+
+def test_eviction_removes_stale_partial_archives(tmp_path, monkeypatch):
+    monkeypatch.setattr(archives, 'ARCHIVE_CACHE_DIR', str(tmp_path))
+    stale = _write(tmp_path / 'killed.tmp', b'partial')
+    building = _write(tmp_path / 'building.tmp', b'partial')
+    old = time.time() - archives.ARCHIVE_TMP_MAX_AGE - 1
+    os.utime(stale, (old, old))
+
+    archives.evict_archive_cache()
+    assert not os.path.exists(stale)
+    assert os.path.exists(building)
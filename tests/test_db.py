@@ -0,0 +1,100 @@
+import pytest
+
+import db
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, 'DATABASE', str(tmp_path / 'gallery.db'))
+    db.close_all_connections()
+    db.init_db()
+    yield db.get_db_connection()
+    db.close_all_connections()
+
+def _count(conn, table, where, *params):
+    return conn.execute(f'SELECT COUNT(*) FROM [{table}] WHERE {where}', params).fetchone()[0]
+
+def _add_reference(name):
+    return db.add_reference(f'{name}.jpg', name, 'cat', 'sub', '', 1, 0)
+
+def test_foreign_keys_enforced(database):
+    assert database.execute('PRAGMA foreign_keys').fetchone()[0] == 1
+
+def test_delete_commission_deletes_images(database):
+    artist_id = db.add_artist('Artist', '', '')
+    commission_id = db.add_commission('Title', artist_id, '', 0, None, '', None, 1)
+    image_id = db.add_commission_image(commission_id, f'{commission_id}/original/a.jpg', 0)
+    db.add_image_derivatives(db.DERIVATIVE_KIND_COMMISSION_IMAGE, image_id,
+                             [{'width': 160, 'height': 120, 'format': 'webp', 'path': 'a_160w.webp'}])
+
+    db.delete_commission(commission_id)
+    assert _count(database, 'commission_images', 'commission_id = ?', commission_id) == 0
+    assert _count(database, 'image_derivatives', 'owner_id = ?', image_id) == 0
+
+def test_delete_custom_reference_deletes_items(database):
+    ref_ids = [_add_reference('a'), _add_reference('b')]
+    custom_ref_id = db.create_custom_reference('Set', 'link', ref_ids)
+    artist_id = db.add_artist('Artist', '', '')
+    commission_id = db.add_commission('Title', artist_id, '', 0, None, '', custom_ref_id, 1)
+
+    db.delete_custom_reference(custom_ref_id)
+    assert _count(database, 'custom_reference_items', 'custom_ref_id = ?', custom_ref_id) == 0
+    # The commission stays, unlinked
+    assert database.execute('SELECT custom_ref_id FROM [commissions] WHERE id = ?',
+                            (commission_id,)).fetchone()[0] is None
+
+def test_delete_reference_deletes_items(database):
+    ref_ids = [_add_reference('a'), _add_reference('b')]
+    custom_ref_id = db.create_custom_reference('Set', 'link', ref_ids)
+
+    db.delete_reference(ref_ids[0])
+    assert db.get_selected_references_for_custom_ref(custom_ref_id) == [ref_ids[1]]
+
+def test_orphans_removed_by_migration(database):
+    ref_id = _add_reference('a')
+    custom_ref_id = db.create_custom_reference('Set', 'link', [ref_id])
+    artist_id = db.add_artist('Artist', '', '')
+    commission_id = db.add_commission('Title', artist_id, '', 0, None, '', custom_ref_id, 1)
+    db.add_commission_image(commission_id, f'{commission_id}/original/a.jpg', 0)
+
+    # Parents deleted the way they were before foreign keys were enforced
+    database.execute('PRAGMA foreign_keys = OFF')
+    database.execute('DELETE FROM [custom_references]')
+    database.execute('DELETE FROM [commissions]')
+    database.commit()
+    database.execute('PRAGMA foreign_keys = ON')
+
+    db._migration_foreign_key_orphans(database.cursor())
+    database.commit()
+    assert database.execute('PRAGMA foreign_key_check').fetchall() == []
+    assert _count(database, 'custom_reference_items', '1') == 0
+    assert _count(database, 'commission_images', '1') == 0
+
+def test_settings_reloaded_after_watch_connection_reopens(database):
+    db.complete_setup('admin', 'password', 'Old title')
+    assert db.get_site_title() == 'Old title'
+
+    # Written behind the cache's back, then the watch connection is replaced
+    database.execute("UPDATE [admin] SET site_title = 'New title'")
+    database.commit()
+    db.close_all_connections()
+    assert db.get_site_title() == 'New title'
+
+def test_unique_job_reuses_queued_one(database):
+    job_id = db.enqueue_job('build_archive', {'commission_id': 1}, unique=True)
+    assert db.enqueue_job('build_archive', {'commission_id': 1}, unique=True) == job_id
+    assert db.enqueue_job('build_archive', {'commission_id': 2}, unique=True) != job_id
+
+    db.claim_job('worker')
+    # Started jobs may have read older content: queue a new one
+    assert db.enqueue_job('build_archive', {'commission_id': 1}, unique=True) != job_id
+
+def test_abandoned_job_failed_instead_of_claimed(database):
+    job_id = db.enqueue_job('process_reference', {'ref_id': 1}, max_attempts=1)
+    assert db.claim_job('worker')['id'] == job_id
+    # The worker died during its only attempt
+    database.execute("UPDATE [jobs] SET locked_at = datetime('now', '-1 hour') WHERE id = ?", (job_id,))
+    database.commit()
+
+    assert db.claim_job('worker', lease_seconds=60) is None
+    assert [job['id'] for job in db.fail_abandoned_jobs(lease_seconds=60)] == [job_id]
+    assert db.get_job(job_id)['status'] == 'failed'
@@ -0,0 +1,59 @@
+import pytest
+from PIL import Image, ImageChops, ImageDraw
+
+from utils import draw_outline_text_hollow, get_font
+
+# Largest difference, out of 255, allowed between the outline and the one
+# drawn by the previous implementation. screen() rounds each step where the
+# repeated draws blended, which moves antialiased edges by a few levels.
+OUTLINE_TOLERANCE = 3
+
+def draw_outline_text_hollow_reference(base_img, position, text, font, outline_color, thickness=2):
+    # The previous implementation: the text drawn once per offset of the
+    # outline square, on full-size buffers
+    txt = Image.new('RGBA', base_img.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(txt)
+    x, y = position
+    for dx in range(-thickness, thickness + 1):
+        for dy in range(-thickness, thickness + 1):
+            if dx != 0 or dy != 0:
+                draw.text((x + dx, y + dy), text, font=font, fill=outline_color)
+
+    erase = Image.new('L', base_img.size, 0)
+    ImageDraw.Draw(erase).text(position, text, font=font, fill=255)
+    txt.putalpha(ImageChops.subtract(txt.getchannel('A'), erase))
+    base_img.alpha_composite(txt)
+
+def _max_difference(a, b):
+    extrema = ImageChops.difference(a, b).getextrema()
+    if a.mode == 'L':
+        extrema = [extrema]
+    return max(high for _, high in extrema)
+
+@pytest.mark.parametrize('thickness', [1, 2, 5])
+@pytest.mark.parametrize('font_size', [24, 48, 72])
+@pytest.mark.parametrize('alpha', [255, 128])
+def test_outline_matches_reference(thickness, font_size, alpha):
+    font = get_font(font_size)
+    color = (255, 255, 255, alpha)
+    for background in ((0, 0, 0, 0), (40, 80, 120, 255)):
+        expected = Image.new('RGBA', (700, 200), background)
+        actual = expected.copy()
+        draw_outline_text_hollow_reference(expected, (20, 30), 'DO NOT USE', font, color, thickness)
+        draw_outline_text_hollow(actual, (20, 30), 'DO NOT USE', font, color, thickness)
+
+        assert _max_difference(expected.getchannel('A'), actual.getchannel('A')) <= OUTLINE_TOLERANCE
+        if background[3] == 255:
+            # Colors of fully transparent pixels don't matter
+            assert _max_difference(expected.convert('RGB'), actual.convert('RGB')) <= OUTLINE_TOLERANCE
+
+@pytest.mark.parametrize('position', [(-40, -20), (650, 170)])
+def test_outline_clipped_at_edges(position):
+    # Text partly outside the image is clipped the same way
+    font = get_font(48)
+    color = (255, 255, 255, 255)
+    expected = Image.new('RGBA', (700, 200), (0, 0, 0, 0))
+    actual = expected.copy()
+    draw_outline_text_hollow_reference(expected, position, 'DO NOT USE', font, color, 5)
+    draw_outline_text_hollow(actual, position, 'DO NOT USE', font, color, 5)
+    assert _max_difference(expected.getchannel('A'), actual.getchannel('A')) <= OUTLINE_TOLERANCE
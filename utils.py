@@ -1,155 +1,326 @@
-from PIL import Image, ImageDraw, ImageFont, ImageChops
+from PIL import Image, ImageDraw, ImageFont, ImageChops, ImageOps, features
+from functools import lru_cache
+import hashlib
+import json
 import math
 import os, platform
 
+# Number of rendered watermark tiles kept in memory
+WATERMARK_TILE_CACHE_SIZE = 16
+
+# Watermark settings used when an asset doesn't set its own
+DEFAULT_WATERMARK_TEXT = "DO NOT USE FOR AI TRAINING"
+DEFAULT_WATERMARK_OPACITY = 50  # percent
+DEFAULT_WATERMARK_ANGLE = 30  # degrees
+
+# Font used for watermarks. Set WATERMARK_FONT_PATH to use a bundled font
+# instead of probing the platform's fonts below.
+FONT_PATH = os.environ.get('WATERMARK_FONT_PATH')
+# Number of loaded font sizes kept in memory
+FONT_CACHE_SIZE = 32
+
+# Longest side of the miniatures shown in reference cards
+MINIATURE_SIZE = 300
+# Large images are first reduced to this many times the miniature size,
+# cheaply, before the final LANCZOS resize
+MINIATURE_REDUCING_GAP = 3.0
+
+# Widths of the responsive copies made of every uploaded image
+DERIVATIVE_WIDTHS = (160, 320, 640, 1280, 2048)
+# Formats of the responsive copies; AVIF only if this Pillow can write it
+DERIVATIVE_FORMATS = ('webp', 'avif') if features.check('avif') else ('webp',)
+DERIVATIVE_SAVE_OPTIONS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'avif': {'format': 'AVIF', 'quality': 60},
+}
+
 # Get Fonts
 
-def get_font(font_size):
-    # Common font paths by platform
-    font_paths = []
+@lru_cache(maxsize=1)
+def get_font_path():
+    # Resolved once per process
+    font_paths = [FONT_PATH] if FONT_PATH else []
 
+    # Common font paths by platform
     system = platform.system()
     if system == "Windows":
-        font_paths = [
+        font_paths += [
             "C:\\Windows\\Fonts\\arial.ttf",
             "C:\\Windows\\Fonts\\verdana.ttf"
         ]
     elif system == "Darwin":  # macOS
-        font_paths = [
+        font_paths += [
             "/System/Library/Fonts/Supplemental/Arial.ttf",
             "/System/Library/Fonts/Supplemental/Verdana.ttf"
         ]
     else:  # Linux
-        font_paths = [
+        font_paths += [
             "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
             "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
             "/usr/share/fonts/truetype/freefont/FreeSans.ttf"
         ]
 
-    # Try loading fonts in order of preference
+    # Use the first font that exists and loads
     for path in font_paths:
         if os.path.exists(path):
             try:
-                return ImageFont.truetype(path, font_size)
+                ImageFont.truetype(path, 12)
+                return path
             except IOError:
+                if path == FONT_PATH:
+                    print(f"Error loading font {path}, falling back to system fonts")
                 continue
+    return None
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def get_font(font_size):
+    """
+    Font for the given size, loaded once and shared: don't modify it.
+    """
+    path = get_font_path()
+    if path:
+        try:
+            return ImageFont.truetype(path, font_size)
+        except IOError as e:
+            print(f"Error loading font {path}: {e}")
 
     # Fallback
     return ImageFont.load_default()
 
 # Draw outline text on image
 def draw_outline_text_hollow(base_img, position, text, font, outline_color, thickness=2):
-    # Create a temporary image for drawing the outline
-    txt = Image.new('RGBA', base_img.size, (0, 0, 0, 0))
-    draw = ImageDraw.Draw(txt)
-
     x, y = position
 
-    # Draw text multiple times for the outline
-    for dx in range(-thickness, thickness + 1):
-        for dy in range(-thickness, thickness + 1):
-            if dx != 0 or dy != 0:
-                draw.text((x + dx, y + dy), text, font=font, fill=outline_color)
-
-    # Draw the center text in transparent to "erase" it
-    erase = Image.new('L', base_img.size, 0)
-    erase_draw = ImageDraw.Draw(erase)
-    erase_draw.text(position, text, font=font, fill=255)
-    txt.putalpha(ImageChops.subtract(txt.getchannel('A'), erase))
-
-    # Composite the outline onto the base image
-    base_img.alpha_composite(txt)
+    # Render the text mask once, in a buffer the size of the text plus the outline
+    left, top, right, bottom = ImageDraw.Draw(Image.new('L', (1, 1))).textbbox((0, 0), text, font=font)
+    pad = thickness + 1
+    text_mask = Image.new('L', (right - left + 2 * pad, bottom - top + 2 * pad), 0)
+    ImageDraw.Draw(text_mask).text((pad - left, pad - top), text, font=font, fill=255)
+
+    # Stack the mask over a square of offsets, as a horizontal then a vertical
+    # pass. screen() accumulates coverage like overlapping draws would; the
+    # padding is blank, so offset()'s wrap-around only brings in zeros.
+    outline = text_mask
+    for dx in range(1, thickness + 1):
+        outline = ImageChops.screen(outline, ImageChops.offset(text_mask, dx, 0))
+        outline = ImageChops.screen(outline, ImageChops.offset(text_mask, -dx, 0))
+    horizontal = outline
+    for dy in range(1, thickness + 1):
+        outline = ImageChops.screen(outline, ImageChops.offset(horizontal, 0, dy))
+        outline = ImageChops.screen(outline, ImageChops.offset(horizontal, 0, -dy))
+
+    # Scale to the outline color's alpha and "erase" the text itself
+    alpha = outline_color[3] if len(outline_color) > 3 else 255
+    if alpha != 255:
+        outline = outline.point(lambda value: value * alpha // 255)
+    outline = ImageChops.subtract(outline, text_mask)
+
+    txt = Image.new('RGBA', outline.size, tuple(outline_color[:3]) + (0,))
+    txt.putalpha(outline)
+
+    # Composite the outline onto the base image, clipped to its bounds
+    dest_x = x + left - pad
+    dest_y = y + top - pad
+    src_x = max(0, -dest_x)
+    src_y = max(0, -dest_y)
+    src_right = min(txt.width, base_img.width - dest_x)
+    src_bottom = min(txt.height, base_img.height - dest_y)
+    if src_right > src_x and src_bottom > src_y:
+        base_img.alpha_composite(txt, (dest_x + src_x, dest_y + src_y),
+                                 (src_x, src_y, src_right, src_bottom))
+
+# Filename of the miniature of an image
+def miniature_filename(image_path):
+    name, ext = os.path.splitext(os.path.basename(image_path))
+    return f"{name}_miniature.webp"
 
 # Create miniature version of image in webp format
-def create_miniature(image_path, output_dir=None, max_size=300):
+def create_miniature(image_path, output_dir=None, max_size=MINIATURE_SIZE):
     try:
         # Open the original image
-        img = Image.open(image_path)
-
-        # Calculate new dimensions while maintaining aspect ratio
-        width, height = img.size
-        if width > height:
-            new_width = min(width, max_size)
-            new_height = int(height * (new_width / width))
-        else:
-            new_height = min(height, max_size)
-            new_width = int(width * (new_height / height))
-
-        # Resize the image
-        img = img.resize((new_width, new_height), Image.LANCZOS)
+        with Image.open(image_path) as img:
+            # Let JPEGs decode at 1/2, 1/4 or 1/8 scale when they are much
+            # larger than needed; other formats ignore this
+            draft_size = int(max_size * MINIATURE_REDUCING_GAP)
+            img.draft(img.mode, (draft_size, draft_size))
+
+            # Apply the EXIF orientation so the miniature is shown upright
+            img = ImageOps.exif_transpose(img)
+
+            # Calculate new dimensions while maintaining aspect ratio
+            width, height = img.size
+            if width > height:
+                new_width = min(width, max_size)
+                new_height = int(height * (new_width / width))
+            else:
+                new_height = min(height, max_size)
+                new_width = int(width * (new_height / height))
+
+            # Resize the image, box-reducing by an integer factor first
+            img = img.resize((new_width, new_height), Image.LANCZOS,
+                             reducing_gap=MINIATURE_REDUCING_GAP)
 
         # Determine output path
         if output_dir is None:
             output_dir = os.path.dirname(image_path)
 
-        # Get filename without extension
-        filename = os.path.basename(image_path)
-        name, ext = os.path.splitext(filename)
-
         # Create miniature filename with _miniature suffix and .webp extension
-        miniature_filename = f"{name}_miniature.webp"
-        output_path = os.path.join(output_dir, miniature_filename)
+        filename = miniature_filename(image_path)
+        output_path = os.path.join(output_dir, filename)
 
         # Save as webp with good quality
         img.save(output_path, 'WEBP', quality=80)
 
-        return miniature_filename
+        return filename
     except Exception as e:
         print(f"Error creating miniature: {e}")
         return None
 
+# Open an image, upright and decoded at a reduced scale if that still covers max_width
+def open_for_resize(image_path, max_width):
+    with Image.open(image_path) as img:
+        img.draft(img.mode, (max_width, max_width))
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if img.has_transparency_data else 'RGB')
+        img.load()
+    return img
+
+# Resize an image to width (never enlarging it) and save it in fmt
+def save_resized(image_path, output_path, width, fmt):
+    img = open_for_resize(image_path, width)
+    if img.width > width:
+        height = max(1, round(img.height * width / img.width))
+        img = img.resize((width, height), Image.LANCZOS, reducing_gap=MINIATURE_REDUCING_GAP)
+    img.save(output_path, **DERIVATIVE_SAVE_OPTIONS[fmt])
+    return img.size
+
+# Create responsive copies of an image at several widths
+def create_derivatives(image_path, output_dir, widths=DERIVATIVE_WIDTHS, formats=DERIVATIVE_FORMATS):
+    """
+    Save a copy of image_path in output_dir for every width in widths that
+    is smaller than the image, plus one at the image's own width when that
+    is within the largest width, in every format of formats. Returns a list
+    of dicts with the width, height, format and filename of each copy.
+    """
+    try:
+        widths = sorted(widths)
+        name = os.path.splitext(os.path.basename(image_path))[0]
+
+        img = open_for_resize(image_path, widths[-1])
+        width, height = img.size
+        targets = [target for target in widths if target < width]
+        if width <= widths[-1]:
+            targets.append(width)
+
+        os.makedirs(output_dir, exist_ok=True)
+        derivatives = []
+        # Largest first, each copy resized from the previous one
+        current = img
+        for target in reversed(targets):
+            target_height = max(1, round(height * target / width))
+            if current.width != target:
+                current = current.resize((target, target_height), Image.LANCZOS,
+                                         reducing_gap=MINIATURE_REDUCING_GAP)
+            for fmt in formats:
+                filename = f"{name}_{target}w.{fmt}"
+                current.save(os.path.join(output_dir, filename), **DERIVATIVE_SAVE_OPTIONS[fmt])
+                derivatives.append({'width': target, 'height': target_height,
+                                    'format': fmt, 'filename': filename})
+
+        return derivatives
+    except Exception as e:
+        print(f"Error creating derivatives: {e}")
+        return []
+
+# Render the repeating watermark pattern once as a seamless tile
+@lru_cache(maxsize=WATERMARK_TILE_CACHE_SIZE)
+def get_watermark_tile(watermark_text, font_size, angle=DEFAULT_WATERMARK_ANGLE,
+                       opacity=DEFAULT_WATERMARK_OPACITY):
+    """
+    One period of the watermark pattern as an RGBA tile, cached per
+    (text, font size, angle, opacity). The returned image is shared: don't
+    modify it.
+    """
+    font = get_font(font_size)
+
+    bbox = ImageDraw.Draw(Image.new('RGBA', (1, 1))).textbbox((0, 0), watermark_text, font=font)
+    text_width = max(1, bbox[2] - bbox[0])
+    text_height = max(1, bbox[3] - bbox[1])
+
+    spacing_x = text_width * 3
+    spacing_y = max(1, round(text_height * 2.5))
+
+    txt_img = Image.new('RGBA', (text_width * 2, text_height * 2), (0, 0, 0, 0))
+
+    draw_outline_text_hollow(
+        txt_img,
+        (text_width // 2, text_height // 2),
+        watermark_text,
+        font,
+        outline_color=(128, 128, 128, round(opacity * 255 / 100)),
+        thickness=2
+    )
+
+    rotated_txt_pos = txt_img.rotate(angle, expand=1)
+    rotated_txt_neg = txt_img.rotate(-angle, expand=1)
+
+    # Three texts per period, alternating the rotation
+    stamps = [
+        (-text_width, rotated_txt_pos),
+        (-text_width + spacing_x // 3, rotated_txt_neg),
+        (-text_width + 2 * (spacing_x // 3), rotated_txt_pos),
+    ]
+
+    tile = Image.new('RGBA', (spacing_x, spacing_y), (0, 0, 0, 0))
+    for offset_x, stamp in stamps:
+        # Paste every copy overlapping the tile so the pattern wraps around its edges
+        start_x = offset_x % spacing_x - math.ceil(stamp.width / spacing_x) * spacing_x
+        start_y = -math.ceil(stamp.height / spacing_y) * spacing_y
+        for y in range(start_y, spacing_y, spacing_y):
+            for x in range(start_x, spacing_x, spacing_x):
+                if x + stamp.width > 0 and y + stamp.height > 0:
+                    tile.paste(stamp, (x, y), stamp)
+
+    return tile
+
+# Repeat a tile over an image of the given size
+def fill_with_tile(tile, size):
+    width, height = size
+
+    # Build one row of tiles, then repeat the row; plain pastes, no blending
+    row = Image.new(tile.mode, (width, tile.height))
+    for x in range(0, width, tile.width):
+        row.paste(tile, (x, 0))
+
+    filled = Image.new(tile.mode, size)
+    for y in range(0, height, tile.height):
+        filled.paste(row, (0, y))
+    return filled
+
+# Name of the watermarked copy of an original for the given settings
+def watermark_variant_filename(original_filename, watermark_text=None, opacity=DEFAULT_WATERMARK_OPACITY,
+                               angle=DEFAULT_WATERMARK_ANGLE, ext=None):
+    # Settings are part of the name, so a copy is only rendered once per settings
+    stem, original_ext = os.path.splitext(os.path.basename(original_filename))
+    settings = json.dumps([watermark_text or DEFAULT_WATERMARK_TEXT, opacity, angle])
+    digest = hashlib.sha1(settings.encode()).hexdigest()[:10]
+    return f"{stem}_wm{digest}{ext or original_ext}"
+
 # Add watermark to image
-def add_watermark(image_path, output_path, watermark_text=None):
+def add_watermark(image_path, output_path, watermark_text=None, opacity=DEFAULT_WATERMARK_OPACITY,
+                  angle=DEFAULT_WATERMARK_ANGLE):
     try:
         img = Image.open(image_path)
-        overlay = Image.new('RGBA', img.size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(overlay)
 
         base_font_size = 36
         base_image_width = 1000
         font_size = max(24, min(72, int(img.width * base_font_size / base_image_width)))
-        font = get_font(font_size)
 
         if not watermark_text:
-            watermark_text = "DO NOT USE FOR AI TRAINING"
-
-        bbox = draw.textbbox((0, 0), watermark_text, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-
-        spacing_x = text_width * 3
-        spacing_y = text_height * 2.5
-
-        num_x = math.ceil(img.width / spacing_x) + 2
-        num_y = math.ceil(img.height / spacing_y) + 6
+            watermark_text = DEFAULT_WATERMARK_TEXT
 
-        txt_img = Image.new('RGBA', (text_width * 2, text_height * 2), (0, 0, 0, 0))
-
-        draw_outline_text_hollow(
-            txt_img,
-            (text_width // 2, text_height // 2),
-            watermark_text,
-            font,
-            outline_color=(128, 128, 128, 128),
-            thickness=2
-        )
-
-        rotated_txt_pos = txt_img.rotate(30, expand=1)
-        rotated_txt_neg = txt_img.rotate(-30, expand=1)
-
-        for i in range(num_y):
-            for j in range(num_x):
-                base_x = j * spacing_x - text_width
-                y = i * spacing_y - (spacing_y * 3)
-
-                x = int(base_x)
-                overlay.paste(rotated_txt_pos, (x, int(y)), rotated_txt_pos)
-
-                x = int(base_x + spacing_x // 3)
-                overlay.paste(rotated_txt_neg, (x, int(y)), rotated_txt_neg)
-
-                x = int(base_x + 2 * (spacing_x // 3))
-                overlay.paste(rotated_txt_pos, (x, int(y)), rotated_txt_pos)
+        overlay = fill_with_tile(get_watermark_tile(watermark_text, font_size, angle, opacity), img.size)
 
         if img.mode != 'RGBA':
             img = img.convert('RGBA')
@@ -163,4 +334,24 @@ def add_watermark(image_path, output_path, watermark_text=None):
         return True
     except Exception as e:
         print(f"Error adding watermark: {e}")
-        return False
\ No newline at end of file
+        return False
+
+# Watermarked copy of an original in folder, rendered unless it is already there.
+# Returns its filename, or None if watermarking failed.
+def render_watermark_variant(original_path, folder, settings, ext=None):
+    filename = watermark_variant_filename(original_path, settings['watermark_text'],
+                                          settings['watermark_opacity'], settings['watermark_angle'], ext)
+    path = os.path.join(folder, filename)
+    if os.path.exists(path) or add_watermark(original_path, path, settings['watermark_text'],
+                                             settings['watermark_opacity'], settings['watermark_angle']):
+        return filename
+    return None
+
+# Render the watermarked copy of a commission image, if settings are given, and
+# the responsive copies of image_path, the file it shows. Run in pool processes,
+# which import this module rather than app. Returns the responsive copies, or
+# None if watermarking failed.
+def render_commission_image(original_path, image_path, watermarked_folder, derivatives_folder, settings=None):
+    if settings and not render_watermark_variant(original_path, watermarked_folder, settings, ext='.jpg'):
+        return None
+    return create_derivatives(image_path, derivatives_folder)
@@ -0,0 +1,14 @@
+# Background job worker: run with `python worker.py` next to the web server.
+# Gunicorn starts one itself, see gunicorn_config.py.
+import signal
+import threading
+
+import app  # noqa: F401 - registers the job handlers
+import jobs
+
+if __name__ == '__main__':
+    # Finish the current job before stopping
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    jobs.run_worker(stop_event)